@@ -0,0 +1,188 @@
+"""性能基准：在内存数据库中按不同规模生成虚拟数据，测量各页面的延迟、吞吐量、
+SQL 查询数和加载的 ORM 对象数，超出预算时以非零状态退出。
+
+    python bench.py --scale small --scale medium --json results.json --budget bench_budgets.json
+"""
+import json
+import statistics
+import sys
+import time
+import warnings
+
+import click
+from flask import url_for
+from sqlalchemy import event
+
+from myblogs import create_app
+from myblogs.extensions import db
+
+# 每个规模的 (分类数, 文章数, 评论数)
+SCALES = {
+    'small': (10, 50, 500),
+    'medium': (20, 1000, 20000),
+    'large': (50, 10000, 200000),
+}
+
+ENDPOINTS = ['blog.index', 'blog.show_category', 'blog.show_post', 'admin.manage_post', 'admin.manage_comment']
+
+PASSWORD = 'benchmark'
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+
+    def reset(self):
+        self.queries = self.rows = 0
+
+    def on_execute(self, *args):
+        self.queries += 1
+
+    def on_load(self, target, context):
+        self.rows += 1
+
+
+def build_app(scale, seed, page_cache):
+    from myblogs import fakes
+    from myblogs.models import Admin, Post, rebuild_counters
+    from myblogs.search import rebuild_index
+
+    app = create_app('testing')
+    app.config['MYBLOGS_PAGE_CACHE'] = page_cache
+    app.config['MYBLOGS_CONDITIONAL_GET'] = page_cache
+
+    categories, posts, comments = SCALES[scale]
+    with app.app_context():
+        fakes.seed(seed)
+        db.create_all()
+        fakes.fake_admin()
+        fakes.fake_categories(categories)
+        fakes.fake_posts(posts)
+        fakes.fake_comments(comments)
+        rebuild_counters()
+        admin = Admin.query.first()
+        admin.set_password(PASSWORD)
+        db.session.commit()
+        rebuild_index()
+
+        # 评论最多的文章和第二个分类，最能体现数据量的影响
+        hot_post = Post.query.order_by(Post.comment_count.desc()).first()
+        with app.test_request_context():
+            urls = {
+                'blog.index': url_for('blog.index'),
+                'blog.show_category': url_for('blog.show_category', category_id=2),
+                'blog.show_post': url_for('blog.show_post', post_id=hot_post.id),
+                'admin.manage_post': url_for('admin.manage_post'),
+                'admin.manage_comment': url_for('admin.manage_comment'),
+            }
+        username = admin.username
+    return app, urls, username
+
+
+def measure(app, url, counter, iterations, warmup, client):
+    for i in range(warmup):
+        client.get(url).get_data()
+
+    timings = []
+    queries = rows = 0
+    status = None
+    for i in range(iterations):
+        counter.reset()
+        start = time.perf_counter()
+        response = client.get(url)
+        # 读取响应体，流式渲染的页面在这时才完成渲染
+        response.get_data()
+        timings.append(time.perf_counter() - start)
+        status = response.status_code
+        queries = max(queries, counter.queries)
+        rows = max(rows, counter.rows)
+
+    timings.sort()
+    total = sum(timings)
+    return dict(
+        url=url,
+        status=status,
+        iterations=iterations,
+        mean_ms=round(total / iterations * 1000, 3),
+        p50_ms=round(statistics.median(timings) * 1000, 3),
+        p95_ms=round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 3),
+        rps=round(iterations / total, 1) if total else None,
+        queries=queries,
+        rows=rows,
+    )
+
+
+def run_scale(scale, seed, iterations, warmup, page_cache):
+    app, urls, username = build_app(scale, seed, page_cache)
+    counter = Counter()
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', counter.on_execute)
+    event.listen(db.Model, 'load', counter.on_load, propagate=True)
+    try:
+        anonymous = app.test_client()
+        admin = app.test_client()
+        admin.post('/auth/login', data=dict(username=username, password=PASSWORD))
+        results = {}
+        for endpoint in ENDPOINTS:
+            client = admin if endpoint.startswith('admin.') else anonymous
+            results[endpoint] = measure(app, urls[endpoint], counter, iterations, warmup, client)
+        return results
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter.on_execute)
+        event.remove(db.Model, 'load', counter.on_load)
+
+
+# 预算文件为 {"endpoint": {"queries": 5, "rows": 30, "p95_ms": 50}}，
+# 键为 "scale:endpoint" 的条目只对该规模生效并覆盖前者
+def check_budgets(results, budgets):
+    failures = []
+    for scale, endpoints in results.items():
+        for endpoint, result in endpoints.items():
+            budget = dict(budgets.get(endpoint, {}))
+            budget.update(budgets.get('%s:%s' % (scale, endpoint), {}))
+            for metric, limit in budget.items():
+                if result.get(metric) is not None and result[metric] > limit:
+                    failures.append('%s %s: %s %s > %s' % (scale, endpoint, metric, result[metric], limit))
+            if result['status'] != 200:
+                failures.append('%s %s: status %s' % (scale, endpoint, result['status']))
+    return failures
+
+
+@click.command()
+@click.option('--scale', 'scales', multiple=True, type=click.Choice(list(SCALES)),
+              help='Data scale to benchmark, may be repeated, default is small.')
+@click.option('--iterations', default=50, help='Measured requests per endpoint, default is 50.')
+@click.option('--warmup', default=5, help='Unmeasured requests per endpoint, default is 5.')
+@click.option('--seed', default=42, help='Random seed of the generated data, default is 42.')
+@click.option('--page-cache/--no-page-cache', default=False,
+              help='Keep the page cache and conditional GET on, default is off.')
+@click.option('--budget', type=click.File(), help='JSON file of budgets, see check_budgets().')
+@click.option('--json', 'output', type=click.File('w'), help='Write the results as JSON to this file.')
+def main(scales, iterations, warmup, seed, page_cache, budget, output):
+    """运行性能基准."""
+    warnings.simplefilter('ignore')
+    results = {}
+    for scale in scales or ['small']:
+        click.echo('正在生成 %s 规模的数据...' % scale, err=True)
+        results[scale] = run_scale(scale, seed, iterations, warmup, page_cache)
+        for endpoint, result in results[scale].items():
+            click.echo('%-8s %-22s %8.2fms p50 %8.2fms p95 %8.1f req/s %4d queries %6d rows' % (
+                scale, endpoint, result['p50_ms'], result['p95_ms'], result['rps'] or 0,
+                result['queries'], result['rows']))
+
+    if output is not None:
+        json.dump(results, output, indent=2, sort_keys=True)
+
+    if budget is not None:
+        failures = check_budgets(results, json.load(budget))
+        for failure in failures:
+            click.echo('超出预算: ' + failure, err=True)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,26 @@
 import logging
 import os
+import time
 from logging.handlers import SMTPHandler, RotatingFileHandler
 
 import click
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, g
 from flask_login import current_user
 from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from myblogs.blueprints.admin import admin_bp
 from myblogs.blueprints.auth import auth_bp
 from myblogs.blueprints.blog import blog_bp
-from myblogs.extensions import bootstrap, db, ckeditor, login_manager, csrf, mail, moment, migrate
+from myblogs.caching import dump_instance, load_instance
+from myblogs.emails import dispatcher
+from myblogs.extensions import bootstrap, db, ckeditor, login_manager, csrf, mail, moment, migrate, cache, page_cache, \
+    metrics, assets, throttle
+from myblogs.metrics import incr
 from myblogs.settings import config
-from myblogs.models import Admin, Post, Category, Comment
+from myblogs.models import Admin, Post, Category, Comment, rebuild_counters
+from myblogs.utils import after_response, stream_flush
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -25,6 +32,9 @@ def create_app(config_name=None):
 
     app = Flask('myblogs')
     app.config.from_object(config[config_name]) 
+    # 部署在代理之后时 request.remote_addr 是代理的地址，登录限流需要真实的客户端地址
+    if app.config['MYBLOGS_PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['MYBLOGS_PROXY_FIX_X_FOR'], x_proto=0)
     
     register_logging(app)  # 注册日志处理器
     register_extensions(app)  # 注册扩展（扩展初始化）
@@ -33,6 +43,7 @@ def create_app(config_name=None):
     register_errors(app)  # 注册错误处理函数
     register_shell_context(app)  # 注 shell 上下文处理函数命令
     register_template_context(app)  # 注册模板上下文处理函数
+    register_request_handlers(app)  # 注册请求处理函数
     return app
 ''' 
 当这个工厂函数被调用后，首先创建一个特定配置类的程序实例，然后执行一系列注册函数
@@ -41,7 +52,17 @@ def create_app(config_name=None):
 '''
 
 def register_logging(app):
-    pass
+    app.logger.setLevel(logging.INFO)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_dir = app.config['MYBLOGS_LOG_DIR']
+    if not app.debug and not app.testing:
+        os.makedirs(log_dir, exist_ok=True)
+        file_handler = RotatingFileHandler(os.path.join(log_dir, 'myblogs.log'),
+                                           maxBytes=10 * 1024 * 1024, backupCount=10, encoding='utf-8')
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        app.logger.addHandler(file_handler)
 
 
 def register_extensions(app):
@@ -52,7 +73,14 @@ def register_extensions(app):
     ckeditor.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
-    migrate.init_app(app, db)
+    # SQLite 不支持大部分 ALTER TABLE，迁移脚本使用批量模式重建表
+    migrate.init_app(app, db, render_as_batch=True)
+    metrics.init_app(app)
+    cache.init_app(app)
+    page_cache.init_app(app)
+    assets.init_app(app)
+    throttle.init_app(app)
+    dispatcher.init_app(app)
 
 
 def register_blueprints(app):
@@ -68,16 +96,32 @@ def register_shell_context(app):
 
 
 # 处理模板上下文
+# 管理员信息、分类列表和未读评论数几乎每个页面都要用到，从缓存读取，
+# 相关模型提交修改后由 myblogs.caching 中的会话事件自动失效。
 def register_template_context(app):
     @app.context_processor
     def make_template_context():
-        admin = Admin.query.first()
-        categories = Category.query.order_by(Category.name).all()
+        admin_data = cache.get_or_set('admin', lambda: _dump_first(Admin.query),
+                                      app.config['MYBLOGS_ADMIN_CACHE_TIMEOUT'])
+        admin = load_instance(db.session, Admin, admin_data) if admin_data else None
+
+        categories_data = cache.get_or_set(
+            'categories', lambda: [dump_instance(c) for c in Category.query.order_by(Category.name)])
+        categories = [load_instance(db.session, Category, data) for data in categories_data]
+
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()
+            unread_comments = cache.get_or_set(
+                'unread_comments', lambda: Comment.query.filter_by(reviewed=False).count())
         else:
             unread_comments = None
-        return dict(admin=admin, categories=categories)
+        return dict(admin=admin, categories=categories, unread_comments=unread_comments)
+
+    app.add_template_global(stream_flush)
+
+
+def _dump_first(query):
+    obj = query.first()
+    return dump_instance(obj) if obj is not None else None
 
 
 def register_errors(app):
@@ -89,6 +133,11 @@ def register_errors(app):
     def page_not_found(e):
         return render_template('errors/404.html'), 404
 
+    @app.errorhandler(429)
+    def too_many_requests(e):
+        headers = {'Retry-After': str(e.retry_after)} if e.retry_after else {}
+        return render_template('errors/429.html'), 429, headers
+
     @app.errorhandler(500)
     def internal_server_error(e):
         return render_template('errors/500.html'), 500
@@ -97,6 +146,45 @@ def register_errors(app):
     def handlers_csrf_error(e):
         return render_template('errors/400.html', description=e.description), 400
 
+# 记录慢查询，并通过 Server-Timing 响应头返回本次请求的数据库耗时；
+# 按端点累计的查询次数、耗时和慢查询数由 /metrics 提供
+def register_request_handlers(app):
+    # 放在最前面，页面缓存提前返回时也能计时
+    def start_timer():
+        g.request_start = time.perf_counter()
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timer)
+
+    # 流式响应在正文生成完之后再记录，包括模板中执行的查询（评论的递归查询、延迟加载）
+    def log_queries(endpoint):
+        queries = get_debug_queries()
+        threshold = app.config['MYBLOGS_SLOW_QUERY_THRESHOLD']
+        slow = 0
+        for q in queries:
+            if q.duration >= threshold:
+                slow += 1
+                app.logger.warning(
+                    'Slow query: Duration: %fs\nEndpoint: %s\nContext: %s\nQuery: %s\nParameters: %r\n'
+                    % (q.duration, endpoint, q.context, q.statement, q.parameters)
+                )
+        if slow:
+            incr('myblogs_sql_slow_queries_total', slow, endpoint=endpoint)
+        app.logger.debug('%s: %d queries, %.1fms', endpoint, len(queries),
+                         sum(q.duration for q in queries) * 1000)
+
+    @app.after_request
+    def query_profiler(response):
+        endpoint = request.endpoint or 'unknown'
+        # 响应头在正文之前发送，流式响应的 Server-Timing 只包含开始发送正文之前的查询和耗时
+        if app.config['MYBLOGS_SERVER_TIMING']:
+            queries = get_debug_queries()
+            duration = sum(q.duration for q in queries)
+            timing = 'db;dur=%.1f;desc="%d queries"' % (duration * 1000, len(queries))
+            if 'request_start' in g:
+                timing += ', app;dur=%.1f' % ((time.perf_counter() - g.request_start) * 1000)
+            response.headers.add('Server-Timing', timing)
+        return after_response(response, lambda: log_queries(endpoint))
+
+
 # 注册自定义 shell 命令
 def register_commands(app):
     # 初始化数据库
@@ -127,6 +215,7 @@ def register_commands(app):
             click.echo('管理员已经存在，正在更新...')
             admin.username = username
             admin.set_password(password)
+            admin.version += 1
         else:
             click.echo('正在创建临时管理员帐户...')
             admin = Admin(
@@ -146,32 +235,196 @@ def register_commands(app):
             db.session.add(category)
 
         db.session.commit()
+        # 文件缓存由所有 worker 共享，删除后立即生效；进程内缓存只能等各个 worker 的缓存过期
+        cache.delete('admin')
         click.echo('管理员账户创建完成.')
+        if app.config['MYBLOGS_CACHE_TYPE'] == 'memory':
+            click.echo('正在运行的 worker 最多 %d 秒后使用新的管理员资料，也可以重启服务.'
+                       % app.config['MYBLOGS_ADMIN_CACHE_TIMEOUT'])
+
+
+    # 重建文章、评论计数
+    @app.cli.command()
+    @click.option('--excerpt', is_flag=True, help='Also regenerate post excerpts.')
+    def recount(excerpt):
+        """重建文章评论数和分类文章数."""
+        rebuild_counters()
+        if excerpt:
+            for post in Post.query.yield_per(100):
+                Post.on_changed_body(post, post.body, None, None)
+        db.session.commit()
+        cache.clear()
+        page_cache.clear()
+        click.echo('计数重建完成.')
 
+    # 重建全文索引
+    @app.cli.command()
+    def reindex():
+        """重建文章和评论的全文索引."""
+        from myblogs.search import rebuild_index
+
+        count = rebuild_index()
+        if count is None:
+            click.echo('当前数据库不支持全文索引，搜索使用 LIKE 查询.')
+        else:
+            click.echo('已索引 %d 条记录.' % count)
+
+    # 把主库复制到 SQLite 副本
+    @app.cli.command()
+    @click.option('--interval', default=0.0, help='Copy again every N seconds, default is 0 (copy once).')
+    def replicate(interval):
+        """把主库复制到 SQLite 只读副本."""
+        import sqlite3
+
+        replicas = db.replica_engines(app)
+        if not replicas:
+            raise click.ClickException('没有配置 MYBLOGS_REPLICA_URLS.')
+        if db.engine.dialect.name != 'sqlite' or any(e.dialect.name != 'sqlite' for name, e in replicas):
+            raise click.ClickException('只支持 SQLite 数据库，其他数据库请使用数据库自带的复制功能.')
+
+        while True:
+            for name, engine in replicas:
+                start = time.perf_counter()
+                # backup API 得到一致的快照，复制期间主库仍可读写
+                try:
+                    source = sqlite3.connect(db.engine.url.database)
+                    target = sqlite3.connect(engine.url.database)
+                    try:
+                        source.backup(target)
+                    finally:
+                        target.close()
+                        source.close()
+                except sqlite3.Error as e:
+                    click.echo('%s: %s 复制失败: %s' % (name, engine.url.database, e), err=True)
+                    continue
+                click.echo('%s: %s，%.2f 秒.' % (name, engine.url.database, time.perf_counter() - start))
+            if not interval:
+                break
+            time.sleep(interval)
+
+    # 检查列表查询是否使用了索引
+    @app.cli.command()
+    @click.option('--analyze', is_flag=True, help='Run ANALYZE first so the planner has statistics.')
+    def explain(analyze):
+        """检查列表查询的执行计划."""
+        from myblogs.queries import listing_queries, query_plan
+
+        if db.engine.dialect.name != 'sqlite':
+            raise click.ClickException('只支持 SQLite 数据库.')
+        if analyze:
+            db.session.execute('ANALYZE')
+            db.session.commit()
+        failed = 0
+        for name, query in listing_queries():
+            plan, problems = query_plan(query)
+            click.echo('%s %s' % ('FAIL' if problems else 'OK  ', name))
+            for detail in plan:
+                click.echo('    ' + detail)
+            failed += bool(problems)
+        if failed:
+            raise click.ClickException('%d 个查询使用了全表扫描或临时排序.' % failed)
+
+    # 打包静态资源
+    @app.cli.command('assets')
+    @click.option('--prune', is_flag=True, help='Delete built files that are not in the new manifest.')
+    def build_assets(prune):
+        """打包、压缩静态资源并生成带哈希的文件名."""
+        from myblogs.assets import build_assets, prune_assets, brotli
+
+        manifest = build_assets(app)
+        for name, filename in sorted(manifest.items()):
+            click.echo('%s -> %s' % (name, filename))
+        if brotli is None:
+            click.echo('没有安装 brotli，只生成了 gzip 版本.')
+        if prune:
+            click.echo('删除 %d 个旧文件.' % prune_assets(app, manifest))
+        assets.set_manifest(app, manifest)
+        page_cache.clear()
+        click.echo('打包完成，重启程序后生效.')
+
+    # 导出静态页面
+    @app.cli.command()
+    @click.option('--output', type=click.Path(file_okay=False), help='Output directory, default is MYBLOGS_EXPORT_DIR.')
+    @click.option('--full', is_flag=True, help='Render every page, not only those changed since the last export.')
+    @click.option('--processes', default=os.cpu_count() or 1, help='Rendering processes, default is the CPU count.')
+    def export(output, full, processes):
+        """把公开页面导出为静态 HTML."""
+        from myblogs.export import export_site
+
+        start = time.perf_counter()
+        written, removed = export_site(output or app.config['MYBLOGS_EXPORT_DIR'], full, processes,
+                                       os.getenv('FLASK_CONFIG'))
+        click.echo('导出 %d 个页面，删除 %d 个页面，%.2f 秒.' % (written, removed, time.perf_counter() - start))
+
+    # 发送 Outbox 中的邮件
+    @app.cli.command()
+    @click.option('--batch', default=50, help='Messages per batch, default is 50.')
+    @click.option('--interval', default=5.0, help='Seconds to wait when the outbox is empty, default is 5.')
+    @click.option('--once', is_flag=True, help='Exit when no message is due.')
+    def outbox(batch, interval, once):
+        """发送待发送的邮件，可以同时运行多个进程."""
+        from myblogs.emails import deliver_outbox
+
+        while True:
+            sent, failed = deliver_outbox(batch)
+            if sent or failed:
+                click.echo('发送 %d 封，失败 %d 封.' % (sent, failed))
+                continue
+            if once:
+                break
+            time.sleep(interval)
 
     # 生成博客虚拟数据
     @app.cli.command()
     @click.option('--category', default=10, help='Quantity of categories, default is 10.')
     @click.option('--post', default=50, help='Quantity of posts, default is 50.')
     @click.option('--comment', default=500, help='Quantity of comments, default is 500.')
-    def forge(category, post, comment):
+    @click.option('--seed', type=int, help='Random seed, makes the generated data reproducible.')
+    @click.option('--skew', default=1.0, help='Zipf exponent of comments per post, 0 is uniform, default is 1.0.')
+    @click.option('--chain', default=0.5, help='Probability that a reply continues the previous reply, '
+                                               'default is 0.5.')
+    @click.option('--index/--no-index', default=True, help='Rebuild the search index afterwards.')
+    def forge(category, post, comment, seed, skew, chain, index):
         """生成虚拟数据."""
-        from myblogs.fakes import fake_admin, fake_categories, fake_posts, fake_comments
+        from myblogs import fakes
+        from myblogs.search import rebuild_index, supports_index
+
+        if seed is not None:
+            fakes.seed(seed)
 
         db.drop_all()
         db.create_all()
 
+        def timed(func, *args):
+            start = time.perf_counter()
+            rows = func(*args)
+            elapsed = time.perf_counter() - start
+            click.echo('  %d 行，%.2f 秒，%d 行/秒.' % (rows, elapsed, rows / elapsed if elapsed else 0))
+
         click.echo('正在生成管理员数据...')
-        fake_admin()
+        timed(fakes.fake_admin)
 
         click.echo('正在生成 %d 分类...' % category)
-        fake_categories(category)
+        timed(fakes.fake_categories, category)
 
         click.echo('正在生成 %d 文章...' % post)
-        fake_posts(post)
+        timed(fakes.fake_posts, post)
 
         click.echo('正在生成 %d 评论...' % comment)
-        fake_comments(comment)
+        timed(fakes.fake_comments, comment, skew, chain)
 
-        click.echo('虚拟数据创建完成.')
+        # 批量插入不经过 ORM 事件，统一重建计数、全文索引和缓存
+        click.echo('正在重建计数...')
+        rebuild_counters()
+        db.session.commit()
+        if not supports_index():
+            click.echo('当前数据库不支持全文索引，跳过.')
+        elif index:
+            click.echo('正在重建全文索引...')
+            timed(rebuild_index)
+        else:
+            click.echo('跳过全文索引，稍后可运行 flask reindex.')
+        cache.clear()
+        page_cache.clear()
 
+        click.echo('虚拟数据创建完成.')
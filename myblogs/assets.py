@@ -0,0 +1,160 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import current_app, request, send_from_directory
+
+# flask assets 的输出目录和清单，都在 static 目录下
+DIST_DIR = 'dist'
+MANIFEST = 'dist/manifest.json'
+
+SCRIPTS = ['js/jquery-3.2.1.slim.min.js', 'js/popper.min.js', 'js/bootstrap.min.js',
+           'js/moment-with-locales.min.js', 'js/script.js']
+
+STRING_RE = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+SOURCE_MAP_RE = re.compile(r'^\s*(//[#@]|/\*[#@]) sourceMappingURL=.*$', re.M)
+
+COMPRESSIONS = [('br', '.br'), ('gzip', '.gz')]
+
+
+# 打包的资源：名称 -> 按顺序合并的源文件。每个主题一个 CSS 包，
+# 主题样式在前，保证其中的 @import 仍在文件开头
+def bundles(app):
+    result = {'js/base.js': SCRIPTS, 'favicon.ico': ['favicon.ico']}
+    for theme in app.config['MYBLOGS_THEMES']:
+        result['css/%s.css' % theme] = ['css/%s.min.css' % theme, 'css/style.css']
+    return result
+
+
+# 去掉注释和多余的空白，字符串（例如 data URI）保持不变
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    parts = STRING_RE.split(text)
+    for i in range(0, len(parts), 2):
+        part = re.sub(r'\s+', ' ', parts[i])
+        parts[i] = re.sub(r'\s*([{};,>])\s*', r'\1', part).replace(';}', '}')
+    return ''.join(parts).strip()
+
+
+# 第三方脚本已经压缩过，只去掉 source map 注释（打包后对应的 .map 文件不存在）
+def _concat(static_folder, sources, kind):
+    chunks = []
+    for source in sources:
+        with open(os.path.join(static_folder, source), 'rb') as f:
+            data = f.read()
+        if kind == 'binary':
+            chunks.append(data)
+            continue
+        text = SOURCE_MAP_RE.sub('', data.decode('utf-8'))
+        chunks.append(minify_css(text) if kind == 'css' else text.strip())
+    if kind == 'binary':
+        return b''.join(chunks)
+    # 脚本之间加分号，避免前一个文件没有以分号结尾
+    return ('\n' if kind == 'css' else ';\n').join(chunks).encode('utf-8')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+# 生成打包文件、压缩版本和清单，返回清单 {名称: 带哈希的文件名}
+def build_assets(app):
+    static_folder = app.static_folder
+    manifest = {}
+    for name, sources in bundles(app).items():
+        base, ext = os.path.splitext(name)
+        kind = {'.css': 'css', '.js': 'js'}.get(ext, 'binary')
+        data = _concat(static_folder, sources, kind)
+        digest = hashlib.md5(data).hexdigest()[:12]
+        filename = '%s/%s.%s%s' % (DIST_DIR, base, digest, ext)
+        path = os.path.join(static_folder, filename)
+        _write(path, data)
+        if kind != 'binary':
+            # mtime 固定为 0，相同内容生成相同的压缩文件
+            _write(path + '.gz', gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                _write(path + '.br', brotli.compress(data))
+        manifest[name] = filename
+
+    _write(os.path.join(static_folder, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+# 删除不在清单中的旧版本。已缓存或已导出的页面可能仍引用旧文件，确认不再需要后再删除
+def prune_assets(app, manifest):
+    dist = os.path.join(app.static_folder, DIST_DIR)
+    keep = set(manifest.values()) | {MANIFEST}
+    removed = 0
+    for root, dirs, files in os.walk(dist):
+        for name in files:
+            filename = os.path.relpath(os.path.join(root, name), app.static_folder).replace(os.sep, '/')
+            for encoding, suffix in COMPRESSIONS:
+                if filename.endswith(suffix):
+                    filename = filename[:-len(suffix)]
+            if filename not in keep:
+                os.remove(os.path.join(root, name))
+                removed += 1
+    return removed
+
+
+# 按清单解析 url_for('static', filename=...)，带哈希的文件优先返回预压缩版本，
+# 并允许浏览器长期缓存；没有运行 flask assets 时使用原来的文件
+class Assets(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        manifest = {}
+        path = os.path.join(app.static_folder, MANIFEST)
+        if app.config['MYBLOGS_ASSETS'] and os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        self.set_manifest(app, manifest)
+        app.url_defaults(self._hashed_url)
+        app.jinja_env.globals['asset_bundled'] = self._bundled
+        app.view_functions['static'] = self.send_static_file
+
+    @staticmethod
+    def set_manifest(app, manifest):
+        app.extensions['myblogs_assets'] = (manifest, set(manifest.values()))
+
+    def _hashed_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            manifest = current_app.extensions['myblogs_assets'][0]
+            values['filename'] = manifest.get(values['filename'], values['filename'])
+
+    def _bundled(self, name):
+        return name in current_app.extensions['myblogs_assets'][0]
+
+    def send_static_file(self, filename):
+        app = current_app._get_current_object()
+        if filename not in app.extensions['myblogs_assets'][1]:
+            return app.send_static_file(filename)
+
+        response = None
+        for encoding, suffix in COMPRESSIONS:
+            if request.accept_encodings[encoding] and os.path.exists(os.path.join(app.static_folder,
+                                                                                  filename + suffix)):
+                response = send_from_directory(app.static_folder, filename + suffix,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.headers['Content-Encoding'] = encoding
+                break
+        if response is None:
+            response = app.send_static_file(filename)
+        response.vary.add('Accept-Encoding')
+        # 文件名随内容变化，可以永久缓存
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % app.config['MYBLOGS_ASSET_MAX_AGE']
+        return response
@@ -1,10 +1,14 @@
-from flask import Blueprint, render_template, request, current_app, redirect, url_for, abort, make_response, flash
+from flask import Blueprint, render_template, request, current_app, redirect, url_for, abort, make_response, flash, \
+    session
 from flask_login import login_required, current_user
 
 from myblogs.models import Post, Category, Comment
+from myblogs.bulk import approve_comments, delete_comments, move_posts, delete_posts, set_can_comment
+from myblogs.queries import post_query, comment_filter
+from myblogs.pagination import paginate
 from myblogs.forms import CommentForm, AdminCommentForm, PostForm, CategoryForm, SettingForm
 from myblogs.utils import redirect_back
-from myblogs.extensions import db
+from myblogs.extensions import db, cache, ADMIN_VERSION_KEY
 
 
 
@@ -19,7 +23,10 @@ def settings():
         current_user.blog_title = form.blog_title.data
         current_user.blog_sub_title = form.blog_sub_title.data
         current_user.about = form.about.data
+        current_user.version += 1
         db.session.commit()
+        # 本会话带上新的版本号，其他 worker 看到后重新读取管理员
+        session[ADMIN_VERSION_KEY] = current_user.version
         flash('保存成功！', 'success')
         return redirect(url_for('blog.index'))
     form.name.data = current_user.name
@@ -32,10 +39,9 @@ def settings():
 @admin_bp.route('/post/manage')
 @login_required
 def manage_post():
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['MYBLOGS_MANAGE_POST_PER_PAGE']
-    )
+    per_page = current_app.config['MYBLOGS_MANAGE_POST_PER_PAGE']
+    pagination = paginate(post_query(), Post.timestamp, Post.id, per_page,
+                          total=lambda: cache.get_or_set('post_total', Post.query.count))
     posts = pagination.items
     return render_template('admin/manage_post.html', pagination=pagination, posts=posts)
 
@@ -85,6 +91,31 @@ def delete_post(post_id):
     return redirect_back()
 
 
+# 批量移动、删除文章，开启或关闭评论
+@admin_bp.route('/post/batch', methods=['POST'])
+@login_required
+def batch_posts():
+    action = request.form.get('action', '')
+    ids = request.form.getlist('ids', type=int)
+    if not ids:
+        flash('请先选择文章。', 'warning')
+        return redirect_back()
+
+    if action == 'move':
+        category = Category.query.get_or_404(request.form.get('category_id', type=int))
+        count = move_posts(ids, category)
+        flash('%d 篇文章移至 %s。' % (count, category.name), 'success')
+    elif action == 'delete':
+        count = delete_posts(ids)
+        flash('删除了 %d 篇文章。' % count, 'success')
+    elif action in ('open-comments', 'close-comments'):
+        count = set_can_comment(ids, action == 'open-comments')
+        flash('%d 篇文章的评论功能已%s。' % (count, '开启' if action == 'open-comments' else '关闭'), 'success')
+    else:
+        abort(400)
+    return redirect_back()
+
+
 @admin_bp.route('/post/<int:post_id>/set-comment', methods=['POST'])
 @login_required
 def set_comment(post_id):
@@ -103,16 +134,17 @@ def set_comment(post_id):
 @login_required
 def manage_comment():
     filter_rule = request.args.get('filter', 'all')  # 'all', 'unreviewed', 'admin'
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MYBLOGS_COMMENT_PER_PAGE']
+    filtered_comments = Comment.query.filter(comment_filter(filter_rule))
     if filter_rule == 'unread':
-        filtered_comments = Comment.query.filter_by(reviewed=False)
+        total_key = 'unread_comments'
     elif filter_rule == 'admin':
-        filtered_comments = Comment.query.filter_by(from_admin=True)
+        total_key = 'admin_comment_total'
     else:
-        filtered_comments = Comment.query
+        total_key = 'comment_total'
 
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(filtered_comments, Comment.timestamp, Comment.id, per_page,
+                          total=lambda: cache.get_or_set(total_key, filtered_comments.count))
     comments = pagination.items
     return render_template('admin/manage_comment.html', comments=comments, pagination=pagination)
 
@@ -137,6 +169,32 @@ def delete_comment(comment_id):
     return redirect_back()
 
 
+# 批量审核、删除：选中的评论，或者当前筛选条件下的全部评论（action 以 -all 结尾）
+@admin_bp.route('/comment/batch', methods=['POST'])
+@login_required
+def batch_comments():
+    action = request.form.get('action', '')
+    if action.endswith('-all'):
+        action = action[:-len('-all')]
+        criterion = comment_filter(request.form.get('filter', 'all'))
+    else:
+        ids = request.form.getlist('ids', type=int)
+        if not ids:
+            flash('请先选择评论。', 'warning')
+            return redirect_back()
+        criterion = Comment.id.in_(ids)
+
+    if action == 'approve':
+        count = approve_comments(criterion)
+        flash('批准了 %d 条评论。' % count, 'success')
+    elif action == 'delete':
+        selected, deleted = delete_comments(criterion)
+        flash('删除了 %d 条评论，其中 %d 条是它们的回复。' % (deleted, deleted - selected), 'success')
+    else:
+        abort(400)
+    return redirect_back()
+
+
 @admin_bp.route('/category/manage')
 @login_required
 def manage_category():
@@ -182,6 +240,24 @@ def delete_category(category_id):
     if category.id == 1:
         flash('您无法删除默认类别。', 'warning')
         return redirect(url_for('blog.index'))
-    category.delete()
-    flash('文章类别删除成功。', 'success')
+    moved = category.delete()
+    flash('文章类别删除成功，%d 篇文章移至默认类别。' % moved, 'success')
+    return redirect(url_for('.manage_category'))
+
+
+# 合并分类：文章移到目标分类后删除本分类
+@admin_bp.route('/category/<int:category_id>/merge', methods=['POST'])
+@login_required
+def merge_category(category_id):
+    category = Category.query.get_or_404(category_id)
+    target = Category.query.get_or_404(request.form.get('target_id', type=int))
+    if category.id == 1:
+        flash('您无法合并默认类别。', 'warning')
+        return redirect(url_for('.manage_category'))
+    if target.id == category.id:
+        flash('请选择另一个类别。', 'warning')
+        return redirect(url_for('.manage_category'))
+    name = category.name
+    moved = category.delete(target)
+    flash('%s 已合并到 %s，移动了 %d 篇文章。' % (name, target.name, moved), 'success')
     return redirect(url_for('.manage_category'))
@@ -1,8 +1,10 @@
-from flask import render_template, flash, redirect, url_for, Blueprint
+from flask import render_template, flash, redirect, url_for, Blueprint, request, abort, session
 from flask_login import login_user, logout_user, login_required, current_user
 
+from myblogs.extensions import db, throttle, ADMIN_VERSION_KEY
 from myblogs.models import Admin
 from myblogs.forms import LoginForm
+from myblogs.metrics import incr
 from myblogs.utils import redirect_back
 
 auth_bp = Blueprint('auth', __name__)
@@ -17,12 +19,24 @@ def login():
         username = form.username.data
         password = form.password.data
         remember = form.remember.data
-        admin = Admin.query.first()
+        # 在计算密码哈希之前按客户端 IP 和用户名限流
+        retry_after = throttle.hit(ip=request.remote_addr, username=username)
+        if retry_after:
+            incr('myblogs_login_attempts_total', result='throttled')
+            abort(429, retry_after=retry_after)
+        # 缓存的管理员不含密码哈希，校验密码时从数据库重新读取
+        admin = Admin.query.populate_existing().first()
         if admin:
             if username == admin.username and admin.validate_password(password):
+                # validate_password 可能用新的哈希参数更新了密码
+                db.session.commit()
+                throttle.reset(ip=request.remote_addr, username=username)
                 login_user(admin, remember)
+                session[ADMIN_VERSION_KEY] = admin.version
+                incr('myblogs_login_attempts_total', result='success')
                 flash('欢迎回来', 'info')
                 return redirect_back()
+            incr('myblogs_login_attempts_total', result='failure')
             flash('用户名或密码错误！', 'waring')
         else:
             flash('没有账户！', 'waring')
@@ -32,5 +46,6 @@ def login():
 @login_required
 def logout():
     logout_user()
+    session.pop(ADMIN_VERSION_KEY, None)
     flash('成功退出。', 'info')
     return redirect_back()
\ No newline at end of file
@@ -1,10 +1,14 @@
 from flask import Blueprint, render_template, request, current_app, redirect, url_for, abort, make_response, flash
+from flask_wtf.csrf import generate_csrf
 
 from myblogs.models import Post, Category, Comment
+from myblogs.queries import post_query, reviewed_comments, thread_roots, comment_thread
+from myblogs.pagination import paginate
+from myblogs.search import search as search_posts
 from myblogs.forms import CommentForm, AdminCommentForm
 from myblogs.emails import send_new_reply_email, send_new_comment_email
-from myblogs.utils import redirect_back
-from myblogs.extensions import db
+from myblogs.utils import redirect_back, render_stream
+from myblogs.extensions import db, cache
 
 
 blog_bp = Blueprint('blog', __name__)
@@ -16,11 +20,11 @@ class current_user:
 
 @blog_bp.route('/')
 def index():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MYBLOGS_POST_PER_PAGE']
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(post_query(), Post.timestamp, Post.id, per_page,
+                          total=lambda: cache.get_or_set('post_total', Post.query.count))
     posts = pagination.items
-    return render_template('blog/index.html', pagination=pagination, posts=posts)
+    return render_stream('blog/index.html', pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/about')
@@ -28,24 +32,39 @@ def about():
     return render_template('blog/about.html')
 
 
+@blog_bp.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['MYBLOGS_SEARCH_RESULT_PER_PAGE']
+    pagination = search_posts(q, page, per_page)
+    return render_template('blog/search.html', q=q, pagination=pagination, results=pagination.items)
+
+
 @blog_bp.route('/category/<int:category_id>')
 def show_category(category_id):
     category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MYBLOGS_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).paginate(page, per_page)
+    pagination = paginate(post_query().with_parent(category), Post.timestamp, Post.id, per_page,
+                          total=category.post_count)
     posts = pagination.items
-    return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
+    return render_stream('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
 def show_post(post_id):
     post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['MYBLOGS_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).filter_by(reviewed=True).order_by(Comment.timestamp.asc()).paginate(
-        page, per_page)
-    comments = pagination.items
+    # 楼中楼：按楼层分页，每页的回复用一条递归查询取出；thread 参数只显示某条评论下的回复
+    if current_app.config['MYBLOGS_THREADED_COMMENTS']:
+        thread_id = request.args.get('thread', type=int)
+        roots = reviewed_comments(post).filter_by(id=thread_id) if thread_id else thread_roots(post)
+        pagination = paginate(roots, Comment.timestamp, Comment.id, per_page, desc=False)
+        comments = comment_thread(pagination.items, current_app.config['MYBLOGS_COMMENT_MAX_DEPTH'])
+    else:
+        pagination = paginate(reviewed_comments(post), Comment.timestamp, Comment.id, per_page,
+                              desc=False, total=post.reviewed_comment_count)
+        comments = ((comment, 0, False) for comment in pagination.items)
 
     if current_user.is_authenticated:
         form = AdminCommentForm()
@@ -72,15 +91,17 @@ def show_post(post_id):
             replied_comment = Comment.query.get_or_404(replied_id)
             comment.replied = replied_comment
             send_new_reply_email(replied_comment)
+        if not current_user.is_authenticated:
+            send_new_comment_email(post)  # send notification email to admin
+        # 启用 Outbox 时通知邮件和评论在同一个事务中提交，否则提交成功后才交给发送线程
         db.session.add(comment)
         db.session.commit()
         if current_user.is_authenticated:  # send message based on authentication status
             flash('发表评论.', 'success')
         else:
             flash('谢谢，您的评论将在管理员审查后发布.', 'info')
-            send_new_comment_email(post)  # send notification email to admin
         return redirect(url_for('.show_post', post_id=post_id))
-    return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
+    return render_stream('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
 
 
 @blog_bp.route('/reply/comment/<int:comment_id>')
@@ -89,6 +110,15 @@ def reply_comment(comment_id):
     return redirect(url_for('.show_post', post_id=comment.post_id, reply=comment_id, author=comment.author) + '#comment-form')
 
 
+# 导出的静态页面加载后通过这个地址取得当前会话的 CSRF 令牌
+@blog_bp.route('/csrf-token')
+def csrf_token():
+    response = make_response(generate_csrf())
+    response.mimetype = 'text/plain'
+    response.cache_control.no_store = True
+    return response
+
+
 @blog_bp.route('/change-theme/<theme_name>')
 def change_theme(theme_name):
     if theme_name not in current_app.config['MYBLOGS_THEMES'].keys():
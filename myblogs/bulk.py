@@ -0,0 +1,112 @@
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.orm import aliased
+
+from myblogs.caching import purge_after_commit
+from myblogs.extensions import db
+from myblogs.models import Comment, Post, rebuild_counters
+from myblogs.search import remove_posts, sync_comments
+
+
+# 批量操作用集合式的 UPDATE / DELETE，不逐个加载对象。这些语句不经过 flush，
+# 计数、Post.updated、全文索引和页面缓存在这里处理。
+
+# 每批重新查出仍满足条件的前 MYBLOGS_BULK_CHUNK_SIZE 条评论：处理过的评论已审核或已删除，
+# 不会再被选中。每批提交一次，大量评论时不会长时间占用写锁
+def _comment_batches(criterion, *columns):
+    chunk_size = current_app.config['MYBLOGS_BULK_CHUNK_SIZE']
+    while True:
+        rows = db.session.query(*columns).filter(criterion).order_by(Comment.id).limit(chunk_size).all()
+        if not rows:
+            return
+        yield rows
+
+
+# 重新统计文章的评论数并更新 Post.updated，提交后失效这些文章的页面
+def _touch_posts(post_ids):
+    post_ids = sorted(set(post_id for post_id in post_ids if post_id is not None))
+    if not post_ids:
+        return
+    rebuild_counters(post_ids=post_ids)
+    Post.query.filter(Post.id.in_(post_ids)).update({Post.updated: datetime.utcnow()},
+                                                    synchronize_session=False)
+    purge_after_commit(db.session, ['post:%s' % post_id for post_id in post_ids])
+
+
+# 批准满足 criterion 的未审核评论，返回批准的数量
+def approve_comments(criterion):
+    count = 0
+    for rows in _comment_batches(db.and_(criterion, Comment.reviewed == False),
+                                 Comment.id, Comment.body, Comment.post_id):
+        ids = [row.id for row in rows]
+        Comment.query.filter(Comment.id.in_(ids)).update({Comment.reviewed: True}, synchronize_session=False)
+        sync_comments(ids, rows)
+        _touch_posts(row.post_id for row in rows)
+        db.session.commit()
+        count += len(rows)
+    return count
+
+
+# 删除满足 criterion 的评论及其所有回复，返回 (选中的评论数, 连同回复一共删除的数量)
+def delete_comments(criterion):
+    selected = deleted = 0
+    for rows in _comment_batches(criterion, Comment.id):
+        tree = db.session.query(Comment.id.label('id')) \
+            .filter(Comment.id.in_([row.id for row in rows])).cte('tree', recursive=True)
+        reply = aliased(Comment)
+        tree = tree.union_all(db.session.query(reply.id).filter(reply.replied_id == tree.c.id))
+        subtree = db.session.query(tree.c.id)
+
+        removed = db.session.query(Comment.id, Comment.post_id).filter(Comment.id.in_(subtree)).all()
+        # 一条语句删除整棵回复树，不会先删掉仍被回复引用的评论
+        Comment.query.filter(Comment.id.in_(subtree)).delete(synchronize_session=False)
+        sync_comments([row.id for row in removed])
+        _touch_posts(row.post_id for row in removed)
+        db.session.commit()
+        selected += len(rows)
+        deleted += len(removed)
+    return selected, deleted
+
+
+# 以下批量处理文章，ids 为管理页面中选中的文章，数量不超过一页，在一个事务中完成。
+# 分类的文章数显示在每个页面的侧栏，修改后失效全部页面
+
+def _post_categories(ids):
+    return [category_id for (category_id,) in
+            db.session.query(Post.category_id).filter(Post.id.in_(ids)).distinct() if category_id is not None]
+
+
+# 把文章移到 category，返回移动的文章数
+def move_posts(ids, category):
+    old_categories = _post_categories(ids)
+    moved = Post.query.filter(Post.id.in_(ids), db.or_(Post.category_id != category.id, Post.category_id == None)) \
+        .update({Post.category_id: category.id, Post.updated: datetime.utcnow()}, synchronize_session=False)
+    rebuild_counters(category_ids=old_categories + [category.id])
+    purge_after_commit(db.session, ['site'])
+    db.session.commit()
+    return moved
+
+
+# 删除文章及其全部评论，返回删除的文章数
+def delete_posts(ids):
+    categories = _post_categories(ids)
+    comment_ids = [comment_id for (comment_id,) in db.session.query(Comment.id).filter(Comment.post_id.in_(ids))]
+    post_ids = [post_id for (post_id,) in db.session.query(Post.id).filter(Post.id.in_(ids))]
+    remove_posts(post_ids, comment_ids)
+    # 回复和被回复的评论属于同一篇文章，一条语句一起删除
+    Comment.query.filter(Comment.post_id.in_(post_ids)).delete(synchronize_session=False)
+    deleted = Post.query.filter(Post.id.in_(post_ids)).delete(synchronize_session=False)
+    rebuild_counters(category_ids=categories)
+    purge_after_commit(db.session, ['site'])
+    db.session.commit()
+    return deleted
+
+
+# 开启或关闭文章的评论功能，返回修改的文章数
+def set_can_comment(ids, can_comment):
+    changed = Post.query.filter(Post.id.in_(ids), Post.can_comment != can_comment) \
+        .update({Post.can_comment: can_comment, Post.updated: datetime.utcnow()}, synchronize_session=False)
+    purge_after_commit(db.session, ['post:%s' % post_id for post_id in ids])
+    db.session.commit()
+    return changed
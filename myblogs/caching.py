@@ -0,0 +1,420 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import md5
+from itertools import chain
+
+from flask import current_app, has_app_context, request, session, g, make_response, stream_with_context
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from werkzeug.http import is_resource_modified
+
+from myblogs.metrics import incr
+
+
+# 模型发生变化时需要失效的缓存键
+INVALIDATION_MAP = {
+    'Admin': ['admin'],
+    'Category': ['categories'],
+    'Post': ['post_total'],
+    'Comment': ['unread_comments', 'comment_total', 'admin_comment_total'],
+}
+
+
+# 进程内缓存，每个 worker 各自持有一份；设置 max_size 后按 LRU 淘汰
+class MemoryCache(object):
+
+    def __init__(self, default_timeout=300, max_size=None):
+        self.default_timeout = default_timeout
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            if self.max_size:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# 文件缓存，多个 gunicorn worker 共享同一个目录；文件数超过 max_size 时删除最旧的文件
+class FileSystemCache(object):
+
+    def __init__(self, cache_dir, default_timeout=300, max_size=None):
+        self.cache_dir = cache_dir
+        self.default_timeout = default_timeout
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, md5(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        # 先写临时文件再替换，避免其他进程读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._path(key))
+        if self.max_size:
+            self._prune()
+
+    def _prune(self):
+        filenames = os.listdir(self.cache_dir)
+        if len(filenames) <= self.max_size:
+            return
+        paths = [os.path.join(self.cache_dir, filename) for filename in filenames]
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                pass
+        for path in sorted(mtimes, key=mtimes.get)[:len(paths) - self.max_size]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for filename in os.listdir(self.cache_dir):
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError:
+                pass
+
+
+def make_backend(cache_type, cache_dir, timeout, max_size=None):
+    if cache_type == 'filesystem':
+        return FileSystemCache(cache_dir, timeout, max_size)
+    return MemoryCache(timeout, max_size)
+
+
+class Cache(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['myblogs_cache'] = make_backend(
+            app.config['MYBLOGS_CACHE_TYPE'], app.config['MYBLOGS_CACHE_DIR'],
+            app.config['MYBLOGS_CACHE_DEFAULT_TIMEOUT'])
+
+    @property
+    def backend(self):
+        return current_app.extensions['myblogs_cache']
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    def get_or_set(self, key, creator, timeout=None):
+        value = self.get(key)
+        incr('myblogs_cache_requests_total', cache='data', result='miss' if value is None else 'hit')
+        if value is None:
+            value = creator()
+            if value is not None:
+                self.set(key, value, timeout)
+        return value
+
+
+# 公开页面的缓存标签。每个标签对应一个随机版本号及其生成时间，版本号参与缓存键和
+# ETag 的计算，标签失效时只需换一个版本号，旧页面不再命中，之后由 LRU 或过期时间清理。
+PAGE_TAGS = {
+    'blog.index': lambda view_args: ['site', 'posts'],
+    'blog.show_category': lambda view_args: ['site', 'posts'],
+    'blog.show_post': lambda view_args: ['site', 'post:%s' % view_args['post_id']],
+    'blog.about': lambda view_args: ['site'],
+}
+
+CSRF_PLACEHOLDER = '__MYBLOGS_CSRF_TOKEN__'
+
+
+def purge_pages(tag_backend, tags):
+    now = int(time.time())
+    for tag in tags:
+        tag_backend.set('tag:' + tag, (uuid.uuid4().hex, now), 0)
+
+
+# 匿名读者的整页缓存和条件请求（ETag / Last-Modified / 304），
+# 登录用户、非 GET 请求和带闪现消息的请求不使用。
+# 标签版本号单独保存且不限数量：和页面放在一起会被当作最旧的条目淘汰，使该标签下的页面全部失效
+class PageCache(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['myblogs_page_cache'] = make_backend(
+            app.config['MYBLOGS_PAGE_CACHE_TYPE'], app.config['MYBLOGS_PAGE_CACHE_DIR'],
+            app.config['MYBLOGS_PAGE_CACHE_TIMEOUT'], app.config['MYBLOGS_PAGE_CACHE_SIZE'])
+        app.extensions['myblogs_page_tags'] = make_backend(
+            app.config['MYBLOGS_PAGE_CACHE_TYPE'], app.config['MYBLOGS_PAGE_TAG_DIR'], 0)
+        if app.config['MYBLOGS_PAGE_CACHE'] or app.config['MYBLOGS_CONDITIONAL_GET']:
+            app.before_request(self._load_page)
+            app.after_request(self._save_page)
+
+    @property
+    def backend(self):
+        return current_app.extensions['myblogs_page_cache']
+
+    @property
+    def tag_backend(self):
+        return current_app.extensions['myblogs_page_tags']
+
+    def purge(self, *tags):
+        purge_pages(self.tag_backend, tags)
+
+    def clear(self):
+        self.backend.clear()
+        self.tag_backend.clear()
+
+    def _tag_version(self, tag):
+        version = self.tag_backend.get('tag:' + tag)
+        if version is None:
+            version = (uuid.uuid4().hex, int(time.time()))
+            self.tag_backend.set('tag:' + tag, version, 0)
+        return version
+
+    def _page_versions(self):
+        tags_for = PAGE_TAGS.get(request.endpoint)
+        if tags_for is None or request.method not in ('GET', 'HEAD'):
+            return None
+        if '_flashes' in session or current_user.is_authenticated:
+            return None
+        return [self._tag_version(tag) for tag in tags_for(request.view_args)]
+
+    def _page_key(self, versions):
+        parts = [request.path, request.query_string.decode('latin-1'), request.cookies.get('theme', '')]
+        parts.extend(version for version, modified in versions)
+        return 'page:' + md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    # 页面中的评论表单带有 CSRF 令牌，令牌有有效期，所以 ETag 包含会话中的令牌，
+    # 并按有效期的一半划分时间段，保证浏览器复用的页面里的令牌仍然可用
+    def _validators(self, versions):
+        period = (current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) // 2
+        bucket = int(time.time()) // period * period
+        field_name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+        parts = [request.path, request.query_string.decode('latin-1'), request.cookies.get('theme', ''),
+                 str(session.get(field_name)), str(bucket)]
+        parts.extend(version for version, modified in versions)
+        etag = md5('|'.join(parts).encode('utf-8')).hexdigest()
+        last_modified = datetime.utcfromtimestamp(max([bucket] + [modified for version, modified in versions]))
+        return etag, last_modified
+
+    def _load_page(self):
+        versions = self._page_versions()
+        if versions is None:
+            return None
+
+        if current_app.config['MYBLOGS_CONDITIONAL_GET']:
+            etag, last_modified = self._validators(versions)
+            g.page_validators = etag, last_modified
+            # 内容没有变化时直接返回 304，不查询数据库也不渲染模板
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                incr('myblogs_cache_requests_total', cache='page', result='not_modified')
+                return current_app.response_class(status=304)
+
+        if not current_app.config['MYBLOGS_PAGE_CACHE'] or request.method != 'GET':
+            return None
+        key = self._page_key(versions)
+        g.page_cache_key = key
+        cached = self.backend.get(key)
+        if cached is None:
+            return None
+        g.page_cache_hit = True
+        incr('myblogs_cache_requests_total', cache='page', result='hit')
+        body, content_type = cached
+        # 缓存的页面里 CSRF 令牌已被替换为占位符，这里为当前会话重新生成
+        if CSRF_PLACEHOLDER in body:
+            body = body.replace(CSRF_PLACEHOLDER, generate_csrf())
+        response = make_response(body)
+        response.headers['Content-Type'] = content_type
+        response.headers['X-Page-Cache'] = 'HIT'
+        return response
+
+    def _save_page(self, response):
+        validators = g.get('page_validators')
+        if validators is not None and response.status_code in (200, 304):
+            response.set_etag(validators[0])
+            response.last_modified = validators[1]
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+
+        key = g.get('page_cache_key')
+        if key is None or g.get('page_cache_hit') or response.status_code != 200 \
+                or response.direct_passthrough:
+            return response
+        response.headers['X-Page-Cache'] = 'MISS'
+        incr('myblogs_cache_requests_total', cache='page', result='miss')
+        # 流式响应在发送完成后再保存，客户端中途断开时不保存
+        if response.is_streamed:
+            response.response = stream_with_context(
+                self._save_stream(response.response, key, response.headers['Content-Type']))
+        else:
+            self._save_body(key, response.get_data(as_text=True), response.headers['Content-Type'])
+        return response
+
+    def _save_stream(self, chunks, key, content_type):
+        body = []
+        for chunk in chunks:
+            body.append(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk)
+            yield chunk
+        self._save_body(key, ''.join(body), content_type)
+
+    def _save_body(self, key, body, content_type):
+        token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+        if token:
+            body = body.replace(token, CSRF_PLACEHOLDER)
+        self.backend.set(key, (body, content_type))
+
+
+# 缓存里只保存列值，避免跨请求、跨线程共享 ORM 对象；模型的 CACHE_EXCLUDE 中的列不写入缓存，
+# 还原后访问这些列时从数据库加载
+def dump_instance(obj):
+    mapper = inspect(obj).mapper
+    exclude = getattr(obj, 'CACHE_EXCLUDE', ())
+    return dict((attr.key, getattr(obj, attr.key)) for attr in mapper.column_attrs if attr.key not in exclude)
+
+
+# 把缓存的列值还原成当前会话中的对象，不会触发查询，关系属性仍可按需加载
+def load_instance(session, model, data):
+    obj = model(**data)
+    make_transient_to_detached(obj)
+    return session.merge(obj, load=False)
+
+
+# 首页和分类页显示的文章字段。评论只改动计数和 updated，未审核的评论不会影响列表页
+LISTING_ATTRS = ('title', 'excerpt', 'timestamp', 'category_id', 'category', 'reviewed_comment_count')
+
+
+def _changed(obj, attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+# 对象变化后需要失效的页面标签，修改过的文章只有列表字段变化时才失效列表页。
+# 已审核评论数用 SQL 表达式自增，flush 后没有修改历史，改由评论的审核状态判断
+def _page_tags(model_name, obj, dirty=False):
+    if model_name == 'Post':
+        if dirty and not _changed(obj, LISTING_ATTRS):
+            return ['post:%s' % obj.id]
+        return ['posts', 'post:%s' % obj.id]
+    if model_name == 'Comment':
+        counted = _changed(obj, ('reviewed',)) if dirty else obj.reviewed
+        if counted:
+            return ['posts', 'post:%s' % obj.post_id]
+        return ['post:%s' % obj.post_id]
+    if model_name in ('Admin', 'Category'):
+        return ['site']
+    return []
+
+
+# 记录本次事务中发生变化的模型和页面标签
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_models(session, flush_context):
+    changed = session.info.setdefault('myblogs_changed_models', set())
+    tags = session.info.setdefault('myblogs_page_tags', set())
+    for obj in chain(session.new, session.deleted):
+        model_name = type(obj).__name__
+        changed.add(model_name)
+        tags.update(_page_tags(model_name, obj))
+    for obj in session.dirty:
+        model_name = type(obj).__name__
+        changed.add(model_name)
+        tags.update(_page_tags(model_name, obj, dirty=True))
+
+
+# Query.update() / Query.delete() 只知道模型，受影响的页面由调用方用 purge_after_commit 给出
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _collect_bulk_changed_models(context):
+    context.session.info.setdefault('myblogs_changed_models', set()).add(context.mapper.class_.__name__)
+
+
+def purge_after_commit(session, tags):
+    session.info.setdefault('myblogs_page_tags', set()).update(tags)
+
+
+# 事务提交后按模型失效对应的缓存
+@event.listens_for(Session, 'after_commit')
+def _invalidate_after_commit(session):
+    changed = session.info.pop('myblogs_changed_models', None)
+    tags = session.info.pop('myblogs_page_tags', None)
+    if not changed or not has_app_context():
+        return
+    backend = current_app.extensions.get('myblogs_cache')
+    if backend is not None:
+        for model_name in changed:
+            for key in INVALIDATION_MAP.get(model_name, ()):
+                backend.delete(key)
+    tag_backend = current_app.extensions.get('myblogs_page_tags')
+    if tag_backend is not None and tags:
+        purge_pages(tag_backend, tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_models(session):
+    session.info.pop('myblogs_changed_models', None)
+    session.info.pop('myblogs_page_tags', None)
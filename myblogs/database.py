@@ -0,0 +1,217 @@
+import itertools
+import threading
+import time
+
+import flask_sqlalchemy
+from flask import has_request_context, request, session
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool, StaticPool
+
+REPLICA_PREFIX = 'replica'
+
+
+def _is_file_sqlite(sa_url):
+    return sa_url.drivername == 'sqlite' and sa_url.database not in (None, '', ':memory:')
+
+
+# 每个新连接建立时执行 PRAGMA，WAL 模式写入时不阻塞读取
+def _pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    return set_pragmas
+
+
+# 只读副本的轮询和健康状态：第一次使用前先连接一次，出错的副本在
+# MYBLOGS_REPLICA_RETRY 秒内不再使用，之后重新检查
+class ReplicaSet(object):
+
+    def __init__(self, names, retry):
+        self.names = names
+        self.retry = retry
+        self._counter = itertools.count()
+        self._down_until = {}
+        self._healthy = set()
+        self._watched = set()
+
+    # get_engine(name) 返回副本的引擎；所有副本都不可用时返回 None
+    def choose(self, get_engine):
+        for i in range(len(self.names)):
+            name = self.names[next(self._counter) % len(self.names)]
+            if self._down_until.get(name, 0) > time.time():
+                continue
+            engine = get_engine(name)
+            self._watch(name, engine)
+            if name not in self._healthy:
+                try:
+                    engine.connect().close()
+                except exc.DBAPIError:
+                    self.mark_down(name)
+                    continue
+                self._healthy.add(name)
+            return engine
+        return None
+
+    def mark_down(self, name):
+        self._healthy.discard(name)
+        self._down_until[name] = time.time() + self.retry
+
+    def _watch(self, name, engine):
+        if name in self._watched:
+            return
+        self._watched.add(name)
+
+        def handle_error(context):
+            if isinstance(context.sqlalchemy_exception, (exc.OperationalError, exc.InterfaceError)):
+                self.mark_down(name)
+        event.listen(engine, 'handle_error', handle_error)
+
+
+# GET / HEAD 请求的查询交给只读副本，没有副本时交给文件型 SQLite 的只读连接。
+# 本会话写入过数据之后，以及同一个用户写入后的 MYBLOGS_REPLICA_STICKY 秒内仍读主库，
+# 避免副本延迟导致看不到自己刚提交的修改。
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+
+    def __init__(self, db, **options):
+        self.db = db
+        flask_sqlalchemy.SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._reading(mapper):
+            engine = self.db.get_read_engine(self.app)
+            if engine is not None:
+                return engine
+        return flask_sqlalchemy.SignallingSession.get_bind(self, mapper, clause)
+
+    # 不在 flush 过程中、没有单独指定 __bind_key__ 的查询
+    def _reading(self, mapper):
+        if self._flushing or self.info.get('myblogs_wrote') or not has_request_context():
+            return False
+        if request.method not in ('GET', 'HEAD') \
+                or request.blueprint not in self.app.config['MYBLOGS_READ_BLUEPRINTS']:
+            return False
+        if session.get('myblogs_primary_until', 0) > time.time():
+            return False
+        return mapper is None or 'bind_key' not in mapper.persist_selectable.info
+
+
+# sessionmaker 会另外派生子类，事件注册在 Session 上
+@event.listens_for(orm.Session, 'after_flush')
+def _mark_written(db_session, flush_context):
+    if isinstance(db_session, RoutingSession):
+        db_session.info['myblogs_wrote'] = True
+
+
+# Query.update() / Query.delete() 不经过 flush
+@event.listens_for(orm.Session, 'after_bulk_update')
+@event.listens_for(orm.Session, 'after_bulk_delete')
+def _mark_bulk_written(context):
+    _mark_written(context.session, None)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _stick_to_primary(db_session):
+    if not db_session.info.pop('myblogs_wrote', False) or not has_request_context():
+        return
+    config = db_session.app.config
+    if config['MYBLOGS_REPLICA_STICKY'] and config['MYBLOGS_REPLICA_URLS']:
+        session['myblogs_primary_until'] = int(time.time()) + config['MYBLOGS_REPLICA_STICKY']
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def _forget_written(db_session):
+    db_session.info.pop('myblogs_wrote', None)
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        self._read_engines = {}
+        self._read_engine_lock = threading.Lock()
+        flask_sqlalchemy.SQLAlchemy.__init__(self, *args, **kwargs)
+
+    # 把副本地址注册为 replica0、replica1…… 等 bind，沿用 Flask-SQLAlchemy 的引擎管理
+    def init_app(self, app):
+        urls = app.config['MYBLOGS_REPLICA_URLS']
+        if urls:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            names = []
+            for i, url in enumerate(urls):
+                names.append('%s%d' % (REPLICA_PREFIX, i))
+                binds[names[-1]] = url
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.extensions['myblogs_replicas'] = ReplicaSet(names, app.config['MYBLOGS_REPLICA_RETRY'])
+        flask_sqlalchemy.SQLAlchemy.init_app(self, app)
+
+    def replica_engines(self, app):
+        replicas = app.extensions.get('myblogs_replicas')
+        if replicas is None:
+            return []
+        return [(name, self.get_engine(app, bind=name)) for name in replicas.names]
+
+    # create_all() / drop_all() 不处理副本，副本的表结构由复制得到
+    def _execute_for_all_tables(self, app, bind, operation, skip_tables=False):
+        if bind == '__all__':
+            replicas = self.get_app(app).extensions.get('myblogs_replicas')
+            binds = self.get_app(app).config.get('SQLALCHEMY_BINDS') or ()
+            bind = [None] + [key for key in binds if replicas is None or key not in replicas.names]
+        flask_sqlalchemy.SQLAlchemy._execute_for_all_tables(self, app, bind, operation, skip_tables)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        flask_sqlalchemy.SQLAlchemy.apply_driver_hacks(self, app, sa_url, options)
+        if not _is_file_sqlite(sa_url) or options.get('poolclass') is StaticPool:
+            return
+        # Flask-SQLAlchemy 默认给文件型 SQLite 用 NullPool，每次都要重新连接并执行 PRAGMA
+        if app.config['MYBLOGS_SQLITE_POOL_SIZE']:
+            options['poolclass'] = QueuePool
+            options['pool_size'] = app.config['MYBLOGS_SQLITE_POOL_SIZE']
+            options.setdefault('max_overflow', app.config['MYBLOGS_SQLITE_MAX_OVERFLOW'])
+            options.setdefault('pool_timeout', app.config['MYBLOGS_SQLITE_POOL_TIMEOUT'])
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        # create_engine 取出后注册到连接事件上
+        options['myblogs_pragmas'] = list(app.config['MYBLOGS_SQLITE_PRAGMAS'].items())
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('myblogs_pragmas', None)
+        engine = flask_sqlalchemy.SQLAlchemy.create_engine(self, sa_url, engine_opts)
+        if pragmas:
+            event.listen(engine, 'connect', _pragma_listener(pragmas))
+        return engine
+
+    # 轮流返回一个可用的副本；没有配置副本时返回文件型 SQLite 的只读引擎：
+    # 另一个连接池，连接设置了 query_only，与写连接互不占用。都没有时返回 None
+    def get_read_engine(self, app):
+        replicas = app.extensions.get('myblogs_replicas')
+        if replicas is not None:
+            return replicas.choose(lambda name: self.get_engine(app, bind=name))
+
+        if not app.config['MYBLOGS_SQLITE_READ_ONLY']:
+            return None
+        engine = self.get_engine(app)
+        if not _is_file_sqlite(engine.url):
+            return None
+        key = app, str(engine.url)
+        read_engine = self._read_engines.get(key)
+        if read_engine is not None:
+            return read_engine
+
+        with self._read_engine_lock:
+            if key not in self._read_engines:
+                options = dict(connect_args={'check_same_thread': False})
+                if app.config['MYBLOGS_SQLITE_POOL_SIZE']:
+                    options.update(poolclass=QueuePool, pool_size=app.config['MYBLOGS_SQLITE_POOL_SIZE'],
+                                   max_overflow=app.config['MYBLOGS_SQLITE_MAX_OVERFLOW'],
+                                   pool_timeout=app.config['MYBLOGS_SQLITE_POOL_TIMEOUT'])
+                pragmas = list(app.config['MYBLOGS_SQLITE_PRAGMAS'].items()) + [('query_only', 'ON')]
+                options['myblogs_pragmas'] = pragmas
+                read_engine = self.create_engine(engine.url, options)
+                # 让 get_debug_queries() 也能记录只读连接上的查询
+                if flask_sqlalchemy._record_queries(app):
+                    flask_sqlalchemy._EngineDebuggingSignalEvents(read_engine, app.import_name).register()
+                self._read_engines[key] = read_engine
+        return self._read_engines[key]
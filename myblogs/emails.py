@@ -1,31 +1,267 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
 from flask import url_for, current_app
 from flask_mail import Message
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
-from myblogs.extensions import mail
+from myblogs.extensions import db, mail
+from myblogs.models import Outbox
 
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+def _deliver(connection, message):
+    if connection is not None:
+        try:
+            connection.send(message)
+            return connection
+        except (smtplib.SMTPServerDisconnected, OSError):
+            # 复用的连接可能已被服务器断开，重新连接后再试一次
+            _close(connection)
+    connection = mail.connect()
+    connection.__enter__()
+    # 新连接上发送失败时先关闭它，调用方拿不到这个连接
+    try:
+        connection.send(message)
+    except Exception:
+        _close(connection)
+        raise
+    return connection
 
 
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            # 连接已断开时 QUIT 会失败，直接关闭套接字
+            if getattr(connection, 'host', None) is not None:
+                connection.host.close()
+    return None
+
+
+# 邮件发送调度器：有界队列 + 固定数量的发送线程，每个线程复用一个 SMTP 连接；
+# 发给管理员的新评论通知在时间窗口内合并成一封摘要邮件，同一篇文章只记一条并累计评论数，
+# 摘要中的文章数达到 MYBLOGS_MAIL_QUEUE_SIZE 时提前发出。
+class MailDispatcher(object):
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.shutdown)
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MYBLOGS_MAIL_QUEUE_SIZE'])
+        self.workers = []
+        self.stats = dict(queued=0, sent=0, failed=0, dropped=0, digested=0)
+        self._lock = threading.Lock()
+        self._digest = OrderedDict()
+        self._digest_timer = None
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _incr(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def _start_workers(self):
+        with self._lock:
+            if self.workers:
+                return
+            for i in range(self.app.config['MYBLOGS_MAIL_WORKERS']):
+                worker = threading.Thread(target=self._work, name='mail-worker-%d' % i, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    # 队列已满时直接丢弃，避免评论刷屏时请求线程被邮件拖住
+    def submit(self, message):
+        self._start_workers()
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            self._incr('dropped')
+            self.app.logger.warning('邮件队列已满，丢弃邮件: %s', message.subject)
+            return False
+        self._incr('queued')
+        return True
+
+    def notify_admin(self, title, url):
+        window = self.app.config['MYBLOGS_MAIL_DIGEST_WINDOW']
+        if not window:
+            return self.submit(_admin_message([(title, url, 1)]))
+        with self._lock:
+            count = self._digest.pop(url, (title, 0))[1]
+            self._digest[url] = (title, count + 1)
+            full = len(self._digest) >= self.app.config['MYBLOGS_MAIL_QUEUE_SIZE']
+            if self._digest_timer is None and not full:
+                self._digest_timer = threading.Timer(window, self.flush_digest)
+                self._digest_timer.daemon = True
+                self._digest_timer.start()
+        if full:
+            self.flush_digest()
+        return True
+
+    def flush_digest(self):
+        with self._lock:
+            digest, self._digest = self._digest, OrderedDict()
+            if self._digest_timer is not None:
+                self._digest_timer.cancel()
+                self._digest_timer = None
+        if not digest:
+            return
+        items = [(title, url, count) for url, (title, count) in digest.items()]
+        self._incr('digested', sum(count for title, url, count in items))
+        with self.app.app_context():
+            self.submit(_admin_message(items))
+
+    def _work(self):
+        idle_timeout = self.app.config['MYBLOGS_MAIL_IDLE_TIMEOUT']
+        with self.app.app_context():
+            connection = None
+            while True:
+                try:
+                    message = self.queue.get(timeout=idle_timeout)
+                except queue.Empty:
+                    # 空闲时关闭连接，下次发送时再重新建立
+                    connection = _close(connection)
+                    continue
+                if message is None:
+                    self.queue.task_done()
+                    break
+                try:
+                    connection = _deliver(connection, message)
+                    self._incr('sent')
+                except Exception:
+                    self.app.logger.exception('邮件发送失败: %s', message.subject)
+                    self._incr('failed')
+                    connection = _close(connection)
+                finally:
+                    self.queue.task_done()
+            _close(connection)
+
+    # 发出摘要邮件并等待队列中的邮件发送完毕
+    def shutdown(self, timeout=10):
+        if self.app is None:
+            return
+        self.flush_digest()
+        for worker in self.workers:
+            try:
+                self.queue.put(None, timeout=timeout)
+            except queue.Full:
+                break
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+
+dispatcher = MailDispatcher()
+
+
+# 不使用 Outbox 时，邮件在当前事务提交成功后才交给调度器，事务回滚时丢弃
+def _after_commit(func, *args):
+    db.session.info.setdefault('myblogs_pending_mail', []).append((func, args))
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_pending_mail(session):
+    for func, args in session.info.pop('myblogs_pending_mail', ()):
+        func(*args)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending_mail(session):
+    session.info.pop('myblogs_pending_mail', None)
+
+
+# 启用 MYBLOGS_MAIL_OUTBOX 时邮件写入 Outbox 表，随调用方的事务一起提交；
+# 否则在调用方提交后交给调度器。两种方式都需要调用方提交事务
 def send_mail(subject, to, html):
-    app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    if current_app.config['MYBLOGS_MAIL_OUTBOX']:
+        db.session.add(Outbox(subject=subject, recipient=to, html=html))
+    else:
+        _after_commit(dispatcher.submit, Message(subject, recipients=[to], html=html))
+    return True
+
+
+# 领取一批到期的邮件：逐行把 next_attempt 推迟 MYBLOGS_OUTBOX_LEASE 秒，
+# 条件更新影响到一行才算领取成功，多个 outbox 进程不会重复发送（SQLite 不支持 SKIP LOCKED）。
+# 进程中途退出时，未处理的邮件在租期过后被重新领取
+def _claim_outbox(now, batch_size):
+    lease = now + timedelta(seconds=current_app.config['MYBLOGS_OUTBOX_LEASE'])
+    due = [item_id for item_id, in db.session.query(Outbox.id).filter(Outbox.next_attempt <= now)
+           .order_by(Outbox.next_attempt).limit(batch_size)]
+    claimed = [item_id for item_id in due
+               if Outbox.query.filter(Outbox.id == item_id, Outbox.next_attempt <= now)
+               .update({Outbox.next_attempt: lease}, synchronize_session=False)]
+    db.session.commit()
+    return Outbox.query.filter(Outbox.id.in_(claimed)).order_by(Outbox.id).all() if claimed else []
+
+
+# 发送一批到期的 Outbox 邮件，共用一个 SMTP 连接；失败的按指数退避重试
+def deliver_outbox(batch_size=50):
+    max_attempts = current_app.config['MYBLOGS_OUTBOX_MAX_ATTEMPTS']
+    retry_delay = current_app.config['MYBLOGS_OUTBOX_RETRY_DELAY']
+    now = datetime.utcnow()
+    items = _claim_outbox(now, batch_size)
+
+    sent = failed = 0
+    connection = None
+    for item in items:
+        message = Message(item.subject, recipients=[item.recipient], html=item.html)
+        try:
+            connection = _deliver(connection, message)
+        except Exception as e:
+            connection = _close(connection)
+            item.attempts += 1
+            item.last_error = str(e)
+            if item.attempts >= max_attempts:
+                item.next_attempt = None
+                current_app.logger.error('邮件 %d 发送失败 %d 次，已放弃: %s', item.id, item.attempts, e)
+            else:
+                item.next_attempt = now + timedelta(seconds=retry_delay * 2 ** (item.attempts - 1))
+            failed += 1
+        else:
+            db.session.delete(item)
+            sent += 1
+        # 逐封提交，进程中途退出时最多重发一封
+        db.session.commit()
+    _close(connection)
+    return sent, failed
+
+
+# items 为 (文章标题, 链接, 评论数) 列表
+def _admin_html(items):
+    if len(items) == 1 and items[0][2] == 1:
+        title, url, count = items[0]
+        html = '<p>文章 <i>%s</i>发表了新评论, 点击下面的链接查看:</p>' \
+               '<p><a href="%s">%s</a></P>' % (title, url, url)
+    else:
+        html = '<p>以下文章发表了 %d 条新评论, 点击链接查看:</p><ul>%s</ul>' % (
+            sum(count for title, url, count in items),
+            ''.join('<li><i>%s</i> (%d): <a href="%s">%s</a></li>' % (title, count, url, url)
+                    for title, url, count in items))
+    return html + '<p><small style="color: #868e96">请不要回复此电子邮件。</small></p>'
+
+
+def _admin_message(items):
+    return Message('新的评论', recipients=[current_app.config['MYBLOGS_EMAIL']], html=_admin_html(items))
 
 
 def send_new_comment_email(post):
     post_url = url_for('blog.show_post', post_id=post.id, _external=True) + '#comments'
-    send_mail(subject='新的评论', to=current_app.config['MYBLOGS_EMAIL'],
-              html='<p>文章 <i>%s</i>发表了新评论, 点击下面的链接查看:</p>'
-                   '<p><a href="%s">%s</a></P>'
-                   '<p><small style="color: #868e96">请不要回复此电子邮件。</small></p>'
-                   % (post.title, post_url, post_url))
+    if current_app.config['MYBLOGS_MAIL_OUTBOX']:
+        send_mail('新的评论', current_app.config['MYBLOGS_EMAIL'], _admin_html([(post.title, post_url, 1)]))
+    else:
+        _after_commit(dispatcher.notify_admin, post.title, post_url)
 
 
 def send_new_reply_email(comment):
@@ -34,4 +270,4 @@ def send_new_reply_email(comment):
               html='<p>您在文章 <i>%s</i> 发表的评论的新回复, 点击下面的链接查看: </p>'
                    '<p><a href="%s">%s</a></p>'
                    '<p><small style="color: #868e96">请不要回复此电子邮件。</small></p>'
-                   % (comment.post.title, post_url, post_url))
\ No newline at end of file
+                   % (comment.post.title, post_url, post_url))
@@ -0,0 +1,199 @@
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from hashlib import md5
+from html import unescape
+from urllib.parse import urlsplit
+
+from flask import current_app, g, url_for
+
+from myblogs.caching import CSRF_PLACEHOLDER
+from myblogs.extensions import db
+from myblogs.models import Admin, Category, Post
+
+# 导出状态：上次导出的开始时间和站点指纹
+STATE_FILE = '.export.json'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+HREF_RE = re.compile(r'href="([^"#]*)')
+
+# 用 nginx 提供导出的页面，没有导出的地址（后台、搜索、提交评论等）交给 Flask：
+#
+#     map $cookie_theme $myblogs_theme { default perfect_blue; black_swan black_swan; }
+#     map $args $myblogs_args { "" ""; default ".$args"; }
+#
+#     location /static/ { alias /path/to/myblogs/static/; }
+#     location /static/dist/ { alias /path/to/myblogs/static/dist/; gzip_static on; expires max; }
+#     location / {
+#         root /path/to/export;
+#         try_files /$myblogs_theme$uri/index$myblogs_args.html @myblogs;
+#         error_page 405 = @myblogs;
+#     }
+#     location @myblogs { proxy_pass http://127.0.0.1:5000; }
+
+
+# /post/3?after=x 保存为 post/3/index.after=x.html，和上面 try_files 的规则一致
+def export_path(url):
+    parts = urlsplit(url)
+    name = 'index.%s.html' % parts.query.replace('/', '%2F') if parts.query else 'index.html'
+    return os.path.join(parts.path.strip('/'), name)
+
+
+# 每个页面都显示的内容：管理员信息、分类及文章数、主题，变化后需要重新导出全部页面
+def site_fingerprint():
+    admin = Admin.query.first()
+    data = [
+        [admin.blog_title, admin.blog_sub_title, admin.name, admin.about] if admin else None,
+        db.session.query(Category.id, Category.name, Category.post_count).order_by(Category.id).all(),
+        sorted(current_app.config['MYBLOGS_THEMES']),
+    ]
+    return md5(json.dumps(data, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def load_state(output):
+    try:
+        with open(os.path.join(output, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# 返回需要渲染的页面路径。站点指纹变化时全部重新渲染，否则只渲染上次导出之后
+# 有变化的文章、它们所在的分类和首页
+def changed_paths(state, fingerprint, full=False):
+    with current_app.test_request_context():
+        if full or state is None or state.get('site') != fingerprint:
+            paths = [url_for('blog.index'), url_for('blog.about')]
+            paths.extend(url_for('blog.show_category', category_id=category_id)
+                         for (category_id,) in db.session.query(Category.id))
+            paths.extend(url_for('blog.show_post', post_id=post_id) for (post_id,) in db.session.query(Post.id))
+            return paths, True
+
+        since = datetime.strptime(state['exported_at'], TIME_FORMAT)
+        changed = db.session.query(Post.id, Post.category_id).filter(Post.updated >= since).all()
+        if not changed:
+            return [], False
+        paths = [url_for('blog.index')]
+        paths.extend(url_for('blog.show_category', category_id=category_id)
+                     for category_id in sorted(set(category_id for post_id, category_id in changed))
+                     if category_id is not None)
+        paths.extend(url_for('blog.show_post', post_id=post_id) for post_id, category_id in changed)
+        return paths, False
+
+
+# 渲染一个页面；页面中的 CSRF 令牌换成占位符，由页面加载后向 blog.csrf_token 获取
+def render_page(app, url, theme):
+    # 单独的程序上下文，每个页面使用新的 g 和数据库会话
+    with app.app_context(), app.test_request_context(url, headers={'Cookie': 'theme=' + theme}):
+        g.static_export = True
+        response = app.full_dispatch_request()
+        if response.status_code != 200:
+            return None
+        html = response.get_data(as_text=True)
+        token = g.get(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+        if token:
+            html = html.replace(token, CSRF_PLACEHOLDER)
+        return html
+
+
+def _write(path, html):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'w', encoding='utf-8') as f:
+        f.write(html)
+    # 先写临时文件再替换，nginx 不会读到写了一半的页面
+    os.replace(temp, path)
+
+
+# 渲染一个路径及其所有分页、楼中楼页面：从页面中找出路径相同、查询参数不同的链接继续渲染。
+# 删除该目录下这次没有生成的旧分页。返回写入的文件（相对导出目录）。
+def render_path(app, output, theme, path):
+    queue, seen, written = [path], {path}, []
+    while queue:
+        url = queue.pop()
+        html = render_page(app, url, theme)
+        if html is None:
+            continue
+        name = os.path.join(theme, export_path(url))
+        _write(os.path.join(output, name), html)
+        written.append(name)
+        for link in HREF_RE.findall(html):
+            link = unescape(link)
+            if urlsplit(link).path == path and link not in seen:
+                seen.add(link)
+                queue.append(link)
+
+    directory = os.path.join(output, theme, path.strip('/'))
+    if os.path.isdir(directory):
+        keep = set(os.path.basename(name) for name in written)
+        for name in os.listdir(directory):
+            if name.startswith('index') and name.endswith('.html') and name not in keep:
+                os.remove(os.path.join(directory, name))
+    return written
+
+
+_worker_app = None
+
+
+def _init_worker(config_name, overrides):
+    global _worker_app
+    from myblogs import create_app
+
+    _worker_app = create_app(config_name)
+    _worker_app.config.update(overrides)
+
+
+def _render_task(args):
+    return render_path(_worker_app, *args)
+
+
+# 删除全量导出后已不存在的页面（例如已删除的文章）和空目录
+def _remove_stale(output, themes, written):
+    removed = 0
+    for theme in themes:
+        for root, dirs, files in os.walk(os.path.join(output, theme), topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.html') and os.path.relpath(path, output) not in written:
+                    os.remove(path)
+                    removed += 1
+            if root != os.path.join(output, theme) and not os.listdir(root):
+                os.rmdir(root)
+    return removed
+
+
+# 导出公开页面。processes 大于 1 时在多个进程中渲染，每个进程用 config_name 创建自己的程序实例；
+# 内存数据库无法跨进程共享，只在当前进程渲染。返回 (写入的页面数, 删除的页面数)
+def export_site(output, full=False, processes=1, config_name=None):
+    app = current_app._get_current_object()
+    # 导出时不经过页面缓存和条件请求
+    overrides = dict(MYBLOGS_PAGE_CACHE=False, MYBLOGS_CONDITIONAL_GET=False)
+    started = datetime.utcnow()
+    state = load_state(output)
+    fingerprint = site_fingerprint()
+    paths, full = changed_paths(state, fingerprint, full)
+    themes = list(app.config['MYBLOGS_THEMES'])
+    tasks = [(output, theme, path) for theme in themes for path in paths]
+
+    written = []
+    if processes > 1 and db.engine.url.database not in (None, '', ':memory:'):
+        with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                 initargs=(config_name, overrides)) as executor:
+            for names in executor.map(_render_task, tasks, chunksize=max(1, len(tasks) // (processes * 8))):
+                written.extend(names)
+    else:
+        saved = dict((key, app.config[key]) for key in overrides)
+        app.config.update(overrides)
+        try:
+            for task in tasks:
+                written.extend(render_path(app, *task))
+        finally:
+            app.config.update(saved)
+
+    removed = _remove_stale(output, themes, set(written)) if full else 0
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, STATE_FILE), 'w') as f:
+        json.dump(dict(exported_at=started.strftime(TIME_FORMAT), site=fingerprint), f)
+    return len(written), removed
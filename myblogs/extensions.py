@@ -1,12 +1,18 @@
+from flask import current_app, session
 from flask_bootstrap import Bootstrap
 from flask_ckeditor import CKEditor
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
 from flask_migrate import Migrate
 
+from myblogs.assets import Assets
+from myblogs.caching import Cache, PageCache, dump_instance, load_instance
+from myblogs.database import SQLAlchemy
+from myblogs.metrics import Metrics
+from myblogs.throttle import Throttle
+
 bootstrap = Bootstrap()
 db = SQLAlchemy()
 login_manager = LoginManager()
@@ -15,13 +21,35 @@ ckeditor = CKEditor()
 mail = Mail()
 moment = Moment()
 migrate = Migrate()
+cache = Cache()
+page_cache = PageCache()
+metrics = Metrics()
+assets = Assets()
+throttle = Throttle()
+
 
+# 会话中保存登录时（或修改资料后）管理员的 version
+ADMIN_VERSION_KEY = 'myblogs_admin_version'
 
+
+# 管理员与模板上下文共用缓存中的 'admin'，不查询数据库。会话中的版本号与缓存不一致时
+# （其他 worker 修改了资料，本 worker 的缓存还是旧的）从数据库重新读取并更新缓存
 @login_manager.user_loader
 def load_user(user_id):
     from myblogs.models import Admin
-    user = Admin.query.get(int(user_id))
-    return user
+
+    data = cache.get('admin')
+    version = session.get(ADMIN_VERSION_KEY)
+    if data is None or data['id'] != int(user_id) or version != data.get('version'):
+        user = Admin.query.get(int(user_id))
+        if user is None:
+            return None
+        data = dump_instance(user)
+        cache.set('admin', data, current_app.config['MYBLOGS_ADMIN_CACHE_TIMEOUT'])
+        if version != user.version:
+            session[ADMIN_VERSION_KEY] = user.version
+        return user
+    return load_instance(db.session, Admin, data)
 
 
 login_manager.login_view = 'auth.login'
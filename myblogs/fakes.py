@@ -1,5 +1,9 @@
-from faker import Faker
 import random
+from array import array
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from faker import Faker
 
 from myblogs.models import Admin, Category, Post, Comment
 from myblogs.extensions import db
@@ -7,6 +11,59 @@ from myblogs.extensions import db
 
 fake = Faker('zh_CN')
 
+# 每批插入的行数
+CHUNK_SIZE = 5000
+# Faker 生成数据很慢，预先生成一批随机值，插入时从中挑选
+POOL_SIZE = 1000
+BODY_POOL_SIZE = 100
+
+_pools = {}
+
+
+# 设置随机种子，相同的种子和参数生成相同的数据
+def seed(value):
+    random.seed(value)
+    fake.seed_instance(value)
+    _pools.clear()
+
+
+def _pool(name, factory, size=POOL_SIZE):
+    if name not in _pools:
+        _pools[name] = [factory() for i in range(size)]
+    return _pools[name]
+
+
+def _next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+# 今年以来的随机时间，用相对年初的秒数表示，方便让回复晚于被回复的评论
+def _time_range():
+    now = datetime.utcnow()
+    start = datetime(now.year, 1, 1)
+    return start, (now - start).total_seconds()
+
+
+# 分批用 executemany 插入，绕过 ORM 的对象构造和 flush 事件；
+# 计数、全文索引和缓存需要调用方在插入后统一重建
+def _insert(model, rows):
+    table = model.__table__
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_SIZE:
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        count += len(chunk)
+    return count
+
+
 # 生成虚拟管理员信息
 def fake_admin():
     admin = Admin(
@@ -18,94 +75,122 @@ def fake_admin():
     )
     db.session.add(admin)
     db.session.commit()
+    return 1
+
 
 # 创建虚拟分类
 def fake_categories(count=10):
-    category = Category(name='Default')
-    db.session.add(category)
+    names = set(name for (name,) in db.session.query(Category.name))
+    rows = []
+    if 'Default' not in names:
+        names.add('Default')
+        rows.append(dict(name='Default'))
 
     for i in range(count):
-        category = Category(name=fake.word())
-        db.session.add(category)
-        try:
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback
+        name = fake.word()
+        n = 2
+        while name in names:
+            name = '%s%d' % (fake.word(), n)
+            n += 1
+        names.add(name)
+        rows.append(dict(name=name))
+    return _insert(Category, rows)
 '''
 这个函数首先会创建一个默认分类， 默认分类是创建文章时默认设置的分类，然后依次生成包含随即名称的虚拟分类。
-分类的名称要求不能重复，如果随机生成的分类名和以创建的分类重名，会抛出sqlalchemy.exc.IntegrityError
-异常，此时调用db.session.rollback()方法进行回滚操作。
+分类的名称要求不能重复，随机生成的分类名已存在时在后面加上序号。
 '''
 
 
 # 生成虚拟文章 默认生成50篇文章，每一篇文章均指定了一个随即分类。
 def fake_posts(count=50):
-    for i in range(count):
-        post = Post(
-            author=fake.name(),
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),
-            timestamp=fake.date_time_this_year()
-        )
-        db.session.add(post)
-    db.session.commit()
+    category_ids = [category_id for (category_id,) in db.session.query(Category.id)]
+    authors = _pool('name', fake.name)
+    titles = _pool('title', fake.sentence)
+    bodies = _pool('body', lambda: fake.text(2000), BODY_POOL_SIZE)
+    # 摘要和字数平时由 Post.body 的 set 事件生成，批量插入时自己算
+    summaries = [Post.summarize(body) for body in bodies]
+    start_time, span = _time_range()
+    start = _next_id(Post)
+
+    def rows():
+        for i in range(count):
+            k = random.randrange(len(bodies))
+            yield dict(
+                id=start + i,
+                author=random.choice(authors),
+                title=random.choice(titles),
+                body=bodies[k],
+                excerpt=summaries[k][0],
+                body_length=summaries[k][1],
+                category_id=random.choice(category_ids),
+                timestamp=start_time + timedelta(seconds=random.random() * span),
+                can_comment=True
+            )
+    return _insert(Post, rows())
 
 
 # 生成虚拟评论 随机生成200条评论， 另外再额外添加40条未审核评论 40条管理员评论和40条回复。
-def fake_comments(count=200):
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
+# 评论按齐普夫分布集中在少数热门文章上（skew 为 0 时均匀分布）；
+# 回复以 chain 的概率接着回复上一条回复，形成较深的回复链。
+def fake_comments(count=200, skew=1.0, chain=0.5):
+    post_ids = [post_id for (post_id,) in db.session.query(Post.id)]
+    random.shuffle(post_ids)
+    cum_weights = list(accumulate(1.0 / (rank + 1) ** skew for rank in range(len(post_ids))))
+    authors = _pool('name', fake.name)
+    emails = _pool('email', fake.email)
+    sites = _pool('url', fake.url)
+    bodies = _pool('sentence', fake.sentence)
+    start_time, span = _time_range()
+    start = _next_id(Comment)
 
     salt = int(count * 0.2)
-    for i in range(salt):
-        # 未审核评论
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-        #管理员发表的评论
-        comment = Comment(
-            author='博客管理员',
-            email='liyuquanmail@163.com',
-            site='jadespring.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            from_admin=True,
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-    db.session.commit()
-    
-    # 回复
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),
-            post=Post.query.get(random.randint(1, Post.query.count()))
+    # 下标为 id - start，记录每条评论所属的文章和时间，供回复使用
+    comment_post = array('l')
+    comment_time = array('d')
+
+    def row(post_id, offset, reviewed=True, from_admin=False, replied_id=None):
+        comment_post.append(post_id)
+        comment_time.append(offset)
+        if from_admin:
+            author, email, site = '博客管理员', 'liyuquanmail@163.com', 'jadespring.com'
+        else:
+            author, email, site = random.choice(authors), random.choice(emails), random.choice(sites)
+        return dict(
+            id=start + len(comment_post) - 1,
+            author=author,
+            email=email,
+            site=site,
+            body=random.choice(bodies),
+            timestamp=start_time + timedelta(seconds=offset),
+            reviewed=reviewed,
+            from_admin=from_admin,
+            post_id=post_id,
+            replied_id=replied_id
         )
-        db.session.add(comment)
-    db.session.commit()
-        
+
+    def rows():
+        for i in range(count):
+            post_id = random.choices(post_ids, cum_weights=cum_weights)[0]
+            yield row(post_id, random.random() * span)
+
+        for i in range(salt):
+            # 未审核评论
+            post_id = random.choices(post_ids, cum_weights=cum_weights)[0]
+            yield row(post_id, random.random() * span, reviewed=False)
+
+            # 管理员发表的评论
+            post_id = random.choices(post_ids, cum_weights=cum_weights)[0]
+            yield row(post_id, random.random() * span, from_admin=True)
+
+        # 回复，和被回复的评论属于同一篇文章，时间在其之后
+        tail = None
+        for i in range(salt if count else 0):
+            if tail is None or random.random() >= chain:
+                tail = random.randrange(count)
+            offset = min(comment_time[tail] + random.random() * 86400 * 2, span)
+            yield row(comment_post[tail], offset, replied_id=start + tail)
+            tail = len(comment_post) - 1
+
+    if not post_ids:
+        return 0
+    return _insert(Comment, rows())
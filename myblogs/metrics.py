@@ -0,0 +1,203 @@
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from flask import current_app, g, request, abort, before_render_template, template_rendered
+from flask_sqlalchemy import get_debug_queries
+
+from myblogs.utils import after_response
+
+# 直方图的桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'myblogs_requests_total': ('counter', 'HTTP requests by endpoint and status.'),
+    'myblogs_request_duration_seconds': ('histogram', 'Request latency by endpoint.'),
+    'myblogs_sql_queries_total': ('counter', 'SQL queries by endpoint.'),
+    'myblogs_sql_query_duration_seconds': ('histogram', 'SQL query duration by endpoint.'),
+    'myblogs_sql_slow_queries_total': ('counter', 'SQL queries over MYBLOGS_SLOW_QUERY_THRESHOLD by endpoint.'),
+    'myblogs_template_render_seconds': ('histogram', 'Template render time by template.'),
+    'myblogs_cache_requests_total': ('counter', 'Cache lookups by cache and result.'),
+    'myblogs_login_attempts_total': ('counter', 'Login attempts by result.'),
+    'myblogs_mail_queue_depth': ('gauge', 'Messages waiting in the mail queue.'),
+    'myblogs_mail_messages_total': ('counter', 'Mail dispatcher messages by state.'),
+}
+
+
+# 把多个计数表加起来，返回 (counters, histograms)
+def _merge(shards):
+    counters = defaultdict(float)
+    histograms = {}
+    for shard_counters, shard_histograms in shards:
+        for key, value in shard_counters.copy().items():
+            counters[key] += value
+        for key, histogram in shard_histograms.copy().items():
+            histogram = list(histogram)
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], histogram)]
+            else:
+                histograms[key] = histogram
+    return counters, histograms
+
+
+# 每个线程写自己的计数表，不需要加锁；抓取时把所有线程的计数加起来。
+# 只有本线程会修改自己的表，抓取线程只复制（dict 和 list 的复制在 GIL 下是原子的）。
+# 新线程登记计数表时，把已结束线程的表合并到 _retired，线程不断替换时计数表不会越来越多
+class Registry(object):
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = (defaultdict(float), {})
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = (defaultdict(float), {})
+            with self._lock:
+                self._retire()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    # 调用方持有 _lock。已结束的线程不会再写它的表，可以安全地合并
+    def _retire(self):
+        dead = [shard for thread, shard in self._shards if not thread.is_alive()]
+        if dead:
+            self._retired = _merge([self._retired] + dead)
+            self._shards = [(thread, shard) for thread, shard in self._shards if thread.is_alive()]
+
+    def inc(self, name, value=1, **labels):
+        self._shard()[0][name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard()[1]
+        key = name, tuple(sorted(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            # 各个桶的计数（最后一个是 +Inf）、总和
+            histogram = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        histogram[bisect_left(BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    def collect(self):
+        with self._lock:
+            self._retire()
+            shards = [self._retired] + [shard for thread, shard in self._shards]
+        return _merge(shards)
+
+
+# 在没有应用上下文或未启用指标时什么也不做，供其他模块调用
+def incr(name, value=1, **labels):
+    registry = current_app.extensions.get('myblogs_metrics') if current_app else None
+    if registry is not None:
+        registry.inc(name, value, **labels)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in pairs)
+
+
+def render_metrics(counters, histograms):
+    lines = []
+    by_name = defaultdict(list)
+    for (name, labels), value in counters.items():
+        by_name[name].append((labels, value))
+    for (name, labels), histogram in histograms.items():
+        by_name[name].append((labels, histogram))
+
+    for name in sorted(by_name):
+        metric_type, description = METRICS.get(name, ('untyped', ''))
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if metric_type != 'histogram':
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, [('le', bound)]), cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(value[-1])))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def _format_value(value):
+    return '%d' % value if value == int(value) else repr(value)
+
+
+# 请求、SQL 和模板渲染的指标，文本格式的 /metrics 端点
+class Metrics(object):
+
+    def __init__(self, app=None):
+        self._rendering = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config['MYBLOGS_METRICS']:
+            return
+        app.extensions['myblogs_metrics'] = Registry()
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start_request)
+        app.after_request(self._end_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._end_render, app)
+        app.add_url_rule(app.config['MYBLOGS_METRICS_PATH'], 'metrics', self.scrape)
+
+    @property
+    def registry(self):
+        return current_app.extensions['myblogs_metrics']
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+
+    # 流式响应在正文生成完之后再记录，耗时和查询包括模板渲染的部分
+    def _end_request(self, response):
+        endpoint = request.endpoint or 'unknown'
+        return after_response(response, lambda: self._record(endpoint, response.status_code))
+
+    def _record(self, endpoint, status):
+        registry = self.registry
+        registry.inc('myblogs_requests_total', endpoint=endpoint, status=status)
+        if 'metrics_start' in g:
+            registry.observe('myblogs_request_duration_seconds', time.perf_counter() - g.metrics_start,
+                             endpoint=endpoint)
+        queries = get_debug_queries()
+        if queries:
+            registry.inc('myblogs_sql_queries_total', len(queries), endpoint=endpoint)
+            for query in queries:
+                registry.observe('myblogs_sql_query_duration_seconds', query.duration, endpoint=endpoint)
+
+    def _start_render(self, sender, template, context, **extra):
+        self._rendering.start = time.perf_counter()
+
+    def _end_render(self, sender, template, context, **extra):
+        start = getattr(self._rendering, 'start', None)
+        if start is not None:
+            self._rendering.start = None
+            self.registry.observe('myblogs_template_render_seconds', time.perf_counter() - start,
+                                  template=template.name)
+
+    # 需要带上 Authorization: Bearer <MYBLOGS_METRICS_TOKEN>；没有配置令牌时端点不开放
+    def scrape(self):
+        token = current_app.config['MYBLOGS_METRICS_TOKEN']
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+            abort(403)
+        from myblogs.emails import dispatcher
+
+        counters, histograms = self.registry.collect()
+        if getattr(dispatcher, 'app', None) is not None:
+            counters['myblogs_mail_queue_depth', ()] = dispatcher.queue_depth
+            for state, value in dispatcher.stats.items():
+                counters['myblogs_mail_messages_total', (('state', state),)] = value
+        return current_app.response_class(render_metrics(counters, histograms),
+                                          mimetype='text/plain; version=0.0.4')
@@ -1,7 +1,13 @@
+from collections import defaultdict
 from datetime import datetime
+from itertools import chain
 
+from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
 
 from myblogs.extensions import db
 
@@ -15,29 +21,53 @@ class Admin(db.Model, UserMixin):
     blog_sub_title = db.Column(db.String(100))
     name = db.Column(db.String(30))
     about = db.Column(db.Text)
+    # 资料或密码修改时加一，同时写入会话，load_user 据此判断缓存的管理员是否过期
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+
+    # 缓存（可能是共享的文件缓存）中不保存密码哈希
+    CACHE_EXCLUDE = ('password_hash',)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, current_app.config['MYBLOGS_PASSWORD_HASH_METHOD'])
 
+    # 密码正确且哈希参数与 MYBLOGS_PASSWORD_HASH_METHOD 不同时，用新参数重新计算，由调用方提交
     def validate_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+        if self.password_hash.split('$', 1)[0] != _hash_method():
+            self.set_password(password)
+        return True
+
+
+# pbkdf2 没有写迭代次数时，werkzeug 使用默认值并把它写进哈希
+def _hash_method():
+    method = current_app.config['MYBLOGS_PASSWORD_HASH_METHOD']
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        method += ':%d' % DEFAULT_PBKDF2_ITERATIONS
+    return method
 
 
 # 分类模型
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)
+    # 冗余计数，由 _update_counters 维护，可通过 flask recount 重建
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
     # 与文章建立一对多关系
     posts = db.relationship('Post', back_populates='category')
 
-    def delete(self):
-        default_category = Category.query.get(1)
-        posts = self.posts[:]
-        for posts in posts:
-            posts.category = default_category
+    # 删除分类，文章移到 target 分类（默认为默认分类），也用于合并分类。
+    # 用一条 UPDATE 移动文章，不加载文章对象。返回移动的文章数
+    def delete(self, target=None):
+        if target is None:
+            target = Category.query.get(1)
+        moved = Post.query.filter_by(category_id=self.id).update(
+            {Post.category_id: target.id, Post.updated: datetime.utcnow()}, synchronize_session=False)
+        target.post_count = Category.post_count + moved
         db.session.delete(self)
         db.session.commit()
+        return moved
 
 
 # 文章模型
@@ -46,16 +76,40 @@ class Post(db.Model):
     author = db.Column(db.String(30))
     title = db.Column(db.String(60))
     body = db.Column(db.Text)
+    # 纯文本摘要和字数，正文修改时自动生成，列表页不必加载正文
+    excerpt = db.Column(db.String(300))
+    body_length = db.Column(db.Integer, default=0)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # 文章或其评论最后一次变化的时间，静态导出据此只重新渲染受影响的页面
+    updated = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     can_comment = db.Column(db.Boolean, default=True)
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reviewed_comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
 
-    # 与分类建立一对多关系
+    # 与分类建立一对多关系，active_history 保证修改分类时能拿到旧分类以更新计数
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
-    category = db.relationship('Category', back_populates='posts')
+    category = db.relationship('Category', back_populates='posts', active_history=True)
 
     # 与评论建立一对多双向关系
     comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')
 
+    EXCERPT_LENGTH = 255
+
+    # 返回正文的纯文本摘要和字数
+    @staticmethod
+    def summarize(body):
+        text = Markup(body or '').striptags()
+        if len(text) > Post.EXCERPT_LENGTH:
+            return text[:Post.EXCERPT_LENGTH - 3] + '...', len(text)
+        return text, len(text)
+
+    @staticmethod
+    def on_changed_body(target, value, oldvalue, initiator):
+        target.excerpt, target.body_length = Post.summarize(value)
+
+
+event.listen(Post.body, 'set', Post.on_changed_body)
+
 
 # 评论模型
 class Comment(db.Model):
@@ -73,7 +127,110 @@ class Comment(db.Model):
     post = db.relationship('Post', back_populates='comments')
 
     # 建立邻接列表关系
-    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
     replies = db.relationship('Comment', back_populates='replied', cascade='all, delete-orphan')
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])
-    
+
+
+# 按实际的查询方式建立索引：
+# 文章页的评论 (post_id, reviewed) ORDER BY timestamp，分类页的文章 (category_id) ORDER BY timestamp，
+# 未读评论数和管理后台的“未读”“管理员”筛选使用部分索引，只包含满足条件的行
+db.Index('ix_comment_post_reviewed_timestamp', Comment.post_id, Comment.reviewed, Comment.timestamp)
+db.Index('ix_post_category_timestamp', Post.category_id, Post.timestamp)
+db.Index('ix_comment_unreviewed_timestamp', Comment.timestamp,
+         sqlite_where=Comment.reviewed == False, postgresql_where=Comment.reviewed == False)
+db.Index('ix_comment_admin_timestamp', Comment.timestamp,
+         sqlite_where=Comment.from_admin == True, postgresql_where=Comment.from_admin == True)
+
+
+# 待发送的邮件，和评论在同一个事务中写入，由 flask outbox 命令发送
+class Outbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(100))
+    recipient = db.Column(db.String(254))
+    html = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    # 下次尝试发送的时间，为空表示已放弃
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+# 用 SQL 重新统计所有冗余计数，批量导入数据或计数出错后使用；
+# 批量操作传入 post_ids / category_ids，只重新统计受影响的文章或分类
+def rebuild_counters(post_ids=None, category_ids=None):
+    comment_count = db.select([db.func.count(Comment.id)]).where(Comment.post_id == Post.id)
+    reviewed_count = comment_count.where(Comment.reviewed == True)
+    post_count = db.select([db.func.count(Post.id)]).where(Post.category_id == Category.id)
+    everything = post_ids is None and category_ids is None
+
+    # 用 Query.update()，提交后按模型失效缓存
+    if everything or post_ids:
+        posts = Post.query.filter(Post.id.in_(post_ids)) if post_ids else Post.query
+        posts.update({Post.comment_count: comment_count.as_scalar(),
+                      Post.reviewed_comment_count: reviewed_count.as_scalar()}, synchronize_session=False)
+    if everything or category_ids:
+        categories = Category.query.filter(Category.id.in_(category_ids)) if category_ids else Category.query
+        categories.update({Category.post_count: post_count.as_scalar()}, synchronize_session=False)
+
+
+# 在 flush 之前根据新增、删除和修改的对象累加计数变化，
+# 已持久化的对象用 SQL 表达式自增，避免并发请求互相覆盖。
+# 和其他会话事件一样注册在 Session 类上，任何会话 flush 这些模型时计数都保持一致
+@event.listens_for(Session, 'before_flush')
+def _update_counters(session, flush_context, instances):
+    deltas = defaultdict(int)
+
+    for obj in session.new:
+        if isinstance(obj, Comment) and obj.post is not None:
+            deltas[obj.post, 'comment_count'] += 1
+            if obj.reviewed:
+                deltas[obj.post, 'reviewed_comment_count'] += 1
+        elif isinstance(obj, Post) and obj.category is not None:
+            deltas[obj.category, 'post_count'] += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Comment) and obj.post is not None:
+            deltas[obj.post, 'comment_count'] -= 1
+            if obj.reviewed:
+                deltas[obj.post, 'reviewed_comment_count'] -= 1
+        elif isinstance(obj, Post) and obj.category is not None:
+            deltas[obj.category, 'post_count'] -= 1
+
+    for obj in session.dirty:
+        state = inspect(obj)
+        if isinstance(obj, Comment) and obj.post is not None:
+            history = state.attrs.reviewed.history
+            if history.has_changes():
+                was_reviewed = bool(history.deleted and history.deleted[0])
+                if obj.reviewed and not was_reviewed:
+                    deltas[obj.post, 'reviewed_comment_count'] += 1
+                elif was_reviewed and not obj.reviewed:
+                    deltas[obj.post, 'reviewed_comment_count'] -= 1
+        elif isinstance(obj, Post):
+            history = state.attrs.category.history
+            if history.has_changes():
+                for category in history.deleted:
+                    if category is not None:
+                        deltas[category, 'post_count'] -= 1
+                for category in history.added:
+                    if category is not None:
+                        deltas[category, 'post_count'] += 1
+
+    for (target, attr), delta in deltas.items():
+        if not delta or target in session.deleted:
+            continue
+        if target in session.new:
+            setattr(target, attr, (getattr(target, attr) or 0) + delta)
+        else:
+            setattr(target, attr, getattr(type(target), attr) + delta)
+
+
+# 文章或其评论有新增、修改、删除时更新 Post.updated
+@event.listens_for(Session, 'before_flush')
+def _touch_posts(session, flush_context, instances):
+    now = datetime.utcnow()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        post = obj if isinstance(obj, Post) else obj.post if isinstance(obj, Comment) else None
+        if post is not None and post not in session.deleted:
+            post.updated = now
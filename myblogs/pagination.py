@@ -0,0 +1,77 @@
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import and_, or_
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+# 游标由排序时间戳和 id 组成，例如 20200701083000123456.42
+def encode_cursor(timestamp, id):
+    return '%s.%d' % (timestamp.strftime(CURSOR_FORMAT), id)
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id = cursor.split('.')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+    except ValueError:
+        abort(400)
+
+
+# 基于游标（seek）的分页，按 (时间戳, id) 定位，不需要 OFFSET 和 COUNT(*)。
+# after 表示列表中位于游标之后的一页，before 表示之前的一页；
+# before 为空字符串时返回最后一页。
+class KeysetPagination(object):
+
+    def __init__(self, query, column, id_column, per_page, before=None, after=None, desc=True, total=None):
+        self.per_page = per_page
+        self.total = total
+        self.cursor_based = True
+
+        backwards = before is not None
+        cursor = before if backwards else after
+        # 向前翻页时反向查询，取到结果后再倒回来
+        descending = desc != backwards
+        if cursor:
+            timestamp, id = decode_cursor(cursor)
+            if descending:
+                query = query.filter(or_(column < timestamp, and_(column == timestamp, id_column < id)))
+            else:
+                query = query.filter(or_(column > timestamp, and_(column == timestamp, id_column > id)))
+        if descending:
+            query = query.order_by(column.desc(), id_column.desc())
+        else:
+            query = query.order_by(column.asc(), id_column.asc())
+
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if backwards:
+            items.reverse()
+            self.has_prev = has_more
+            self.has_next = bool(cursor)
+        else:
+            self.has_next = has_more
+            self.has_prev = bool(cursor)
+        self.items = items
+
+        self.prev_cursor = self._cursor(items[0], column, id_column) if self.has_prev and items else None
+        self.next_cursor = self._cursor(items[-1], column, id_column) if self.has_next and items else None
+
+    @staticmethod
+    def _cursor(item, column, id_column):
+        return encode_cursor(getattr(item, column.key), getattr(item, id_column.key))
+
+
+# 默认使用游标分页；带 page 参数的旧链接仍按页码分页
+def paginate(query, column, id_column, per_page, desc=True, total=None):
+    if current_app.config['MYBLOGS_KEYSET_PAGINATION'] and 'page' not in request.args:
+        if callable(total):
+            total = total()
+        return KeysetPagination(query, column, id_column, per_page,
+                                before=request.args.get('before'), after=request.args.get('after'),
+                                desc=desc, total=total)
+    page = request.args.get('page', 1, type=int)
+    order = (column.desc(), id_column.desc()) if desc else (column.asc(), id_column.asc())
+    return query.order_by(*order).paginate(page, per_page)
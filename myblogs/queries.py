@@ -0,0 +1,106 @@
+from collections import defaultdict
+from datetime import datetime
+from itertools import groupby
+
+from sqlalchemy import literal, or_
+from sqlalchemy.orm import aliased, defer, joinedload, selectinload
+
+from myblogs.extensions import db
+from myblogs.models import Post, Comment, Outbox
+
+
+# 文章列表会显示所属分类，连同分类一起查询，避免逐条懒加载；
+# 列表只显示摘要，不加载正文
+def post_query():
+    return Post.query.options(joinedload(Post.category), defer(Post.body))
+
+
+# 评论列表会显示被回复的评论，用一次 IN 查询批量加载
+def comment_query():
+    return Comment.query.options(selectinload(Comment.replied))
+
+
+# 管理后台的评论筛选：'unread' 未审核，'admin' 管理员发表，其他为全部
+def comment_filter(filter_rule):
+    if filter_rule == 'unread':
+        return Comment.reviewed == False
+    if filter_rule == 'admin':
+        return Comment.from_admin == True
+    return db.true()
+
+
+def reviewed_comments(post):
+    return comment_query().with_parent(post).filter_by(reviewed=True)
+
+
+# 楼层：已审核的顶层评论，以及被回复的评论尚未审核的回复
+def thread_roots(post):
+    pending = db.select([Comment.id]).where(Comment.reviewed == False)
+    return reviewed_comments(post).filter(or_(Comment.replied_id == None, Comment.replied_id.in_(pending)))
+
+
+# 用一条递归 CTE 查出这些楼层下所有已审核的回复，按楼层顺序逐条生成
+# (评论, 深度, 是否还有更深的回复)。只展开到 max_depth 层，
+# 多查一层用来判断是否还有更深的回复。结果按楼层排序，用 yield_per 分批读取，
+# 内存中只保留当前楼层的回复，流式渲染时第一个楼层查出后就可以开始输出。
+def comment_thread(roots, max_depth):
+    if not roots:
+        return
+    tree = db.session.query(Comment.id.label('id'), literal(0).label('depth'), Comment.id.label('root_id')) \
+        .filter(Comment.id.in_([root.id for root in roots])).cte('tree', recursive=True)
+    reply = aliased(Comment)
+    tree = tree.union_all(
+        db.session.query(reply.id, tree.c.depth + 1, tree.c.root_id)
+        .filter(reply.replied_id == tree.c.id, reply.reviewed == True, tree.c.depth <= max_depth))
+    position = db.case(dict((root.id, i) for i, root in enumerate(roots)), value=tree.c.root_id)
+    rows = db.session.query(Comment, tree.c.depth, tree.c.root_id).join(tree, Comment.id == tree.c.id) \
+        .order_by(position, Comment.timestamp, Comment.id).yield_per(100)
+
+    for root_id, group in groupby(rows, key=lambda row: row[2]):
+        root = None
+        children = defaultdict(list)
+        more = set()
+        for comment, depth, root_id in group:
+            if depth == 0:
+                root = comment
+            elif depth > max_depth:
+                more.add(comment.replied_id)
+            else:
+                children[comment.replied_id].append(comment)
+
+        stack = [(root, 0)]
+        while stack:
+            comment, depth = stack.pop()
+            yield comment, depth, comment.id in more
+            stack.extend((child, depth + 1) for child in reversed(children[comment.id]))
+
+
+# 各个列表页实际执行的查询，供 flask explain 检查执行计划
+def listing_queries(per_page=10):
+    by_time = (Post.timestamp.desc(), Post.id.desc())
+    comments_by_time = (Comment.timestamp.desc(), Comment.id.desc())
+    return [
+        ('blog.index', post_query().order_by(*by_time).limit(per_page)),
+        ('blog.show_category', post_query().filter(Post.category_id == 1).order_by(*by_time).limit(per_page)),
+        ('blog.show_post', comment_query().filter(Comment.post_id == 1, Comment.reviewed == True)
+            .order_by(Comment.timestamp, Comment.id).limit(per_page)),
+        ('comment replies', Comment.query.filter(Comment.replied_id == 1, Comment.reviewed == True)),
+        ('unread count', Comment.query.filter_by(reviewed=False).from_self(db.func.count('*'))),
+        ('admin.manage_comment unread', Comment.query.filter_by(reviewed=False)
+            .order_by(*comments_by_time).limit(per_page)),
+        ('admin.manage_comment admin', Comment.query.filter_by(from_admin=True)
+            .order_by(*comments_by_time).limit(per_page)),
+        ('outbox', Outbox.query.filter(Outbox.next_attempt <= datetime.utcnow())
+            .order_by(Outbox.next_attempt).limit(per_page)),
+    ]
+
+
+# 返回 SQLite 的 EXPLAIN QUERY PLAN 结果，以及其中的全表扫描和临时排序
+def query_plan(query):
+    connection = db.session.connection()
+    compiled = query.statement.compile(dialect=connection.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    plan = [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + str(compiled), params)]
+    problems = [detail for detail in plan
+                if (detail.startswith('SCAN') and 'USING' not in detail) or 'TEMP B-TREE' in detail]
+    return plan, problems
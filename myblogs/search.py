@@ -0,0 +1,208 @@
+import re
+
+from flask_sqlalchemy import Pagination
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, event, inspect, or_
+from sqlalchemy.orm import Session
+
+from myblogs.extensions import db
+from myblogs.models import Post, Comment
+
+# 全文索引表：rowid 为偶数时对应文章（id * 2），奇数时对应已审核的评论（id * 2 + 1）
+FTS_TABLE = 'search_index'
+
+# unicode61 分词器会把连续的汉字当成一个词，这里在每个汉字后面插入零宽空格，
+# 使每个汉字成为单独的词，查询时按短语匹配，相当于子串搜索
+SEPARATOR = '\u200b'
+CJK_RE = re.compile('([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff])')
+WORD_RE = re.compile(r'\w+')
+
+# snippet() 的高亮标记，转义后再替换成 <mark>
+HIGHLIGHT_OPEN = '\x02'
+HIGHLIGHT_CLOSE = '\x03'
+
+CREATE_TABLE_SQL = "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(" \
+                   "title, body, post_id UNINDEXED, tokenize='unicode61')" % FTS_TABLE
+
+event.listen(Post.__table__, 'after_create', DDL(CREATE_TABLE_SQL).execute_if(dialect='sqlite'))
+event.listen(Post.__table__, 'before_drop', DDL(
+    'DROP TABLE IF EXISTS %s' % FTS_TABLE).execute_if(dialect='sqlite'))
+
+
+def segment(text):
+    return CJK_RE.sub('\\1' + SEPARATOR, text or '')
+
+
+def build_match_query(q):
+    phrases = []
+    for term in q.split():
+        words = WORD_RE.findall(segment(term))
+        if words:
+            phrases.append('"%s"' % ' '.join(words))
+    return ' AND '.join(phrases)
+
+
+def _highlight(text):
+    html = str(escape(text.replace(SEPARATOR, '')))
+    return Markup(html.replace(HIGHLIGHT_OPEN, '<mark>').replace(HIGHLIGHT_CLOSE, '</mark>'))
+
+
+def _post_row(post):
+    return dict(rowid=post.id * 2, title=segment(post.title),
+                body=segment(Markup(post.body or '').striptags()), post_id=post.id)
+
+
+def _comment_row(comment):
+    return dict(rowid=comment.id * 2 + 1, title='', body=segment(comment.body), post_id=comment.post_id)
+
+
+# 全文索引使用 SQLite 的 FTS5，其他数据库不建立索引，搜索退回 LIKE 查询
+def supports_index(connection=None):
+    return (connection or db.session.connection()).dialect.name == 'sqlite'
+
+
+def _index_ready(connection):
+    if not supports_index(connection):
+        return False
+    return connection.execute(db.text(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:name"), name=FTS_TABLE).first() is not None
+
+
+def _write_rows(connection, deletes, inserts):
+    if deletes:
+        connection.execute(db.text('DELETE FROM %s WHERE rowid = :rowid' % FTS_TABLE),
+                           [dict(rowid=rowid) for rowid in deletes])
+    if inserts:
+        connection.execute(db.text('INSERT INTO %s (rowid, title, body, post_id) '
+                                   'VALUES (:rowid, :title, :body, :post_id)' % FTS_TABLE), inserts)
+
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+# 在同一个事务中同步全文索引，只索引文章和已审核的评论。
+# 注册在 Session 类上：直接注册到 db.session 会让它的会话类不再继承 Session 上的事件
+@event.listens_for(Session, 'after_flush')
+def _sync_search_index(session, flush_context):
+    deletes, inserts = [], []
+    for obj in session.new:
+        if isinstance(obj, Post):
+            inserts.append(_post_row(obj))
+        elif isinstance(obj, Comment) and obj.reviewed:
+            inserts.append(_comment_row(obj))
+    for obj in session.dirty:
+        if isinstance(obj, Post) and _changed(obj, 'title', 'body'):
+            deletes.append(obj.id * 2)
+            inserts.append(_post_row(obj))
+        elif isinstance(obj, Comment) and _changed(obj, 'reviewed', 'body'):
+            deletes.append(obj.id * 2 + 1)
+            if obj.reviewed:
+                inserts.append(_comment_row(obj))
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            deletes.append(obj.id * 2)
+        elif isinstance(obj, Comment):
+            deletes.append(obj.id * 2 + 1)
+
+    if not deletes and not inserts:
+        return
+    connection = session.connection()
+    if _index_ready(connection):
+        _write_rows(connection, deletes, inserts)
+
+
+# 批量语句不经过 flush，由调用方同步评论的索引：删除 deleted_ids，写入 comments（已审核的评论）
+def sync_comments(deleted_ids=(), comments=()):
+    connection = db.session.connection()
+    if _index_ready(connection):
+        _write_rows(connection, [comment_id * 2 + 1 for comment_id in deleted_ids],
+                    [_comment_row(comment) for comment in comments])
+
+
+# 批量删除文章时删除文章及其评论的索引
+def remove_posts(post_ids, comment_ids):
+    connection = db.session.connection()
+    if _index_ready(connection):
+        _write_rows(connection, [post_id * 2 for post_id in post_ids]
+                    + [comment_id * 2 + 1 for comment_id in comment_ids], [])
+
+
+# 重建全文索引，数据库不支持时返回 None
+def rebuild_index(chunk_size=500):
+    connection = db.session.connection()
+    if not supports_index(connection):
+        return None
+    connection.execute('DROP TABLE IF EXISTS %s' % FTS_TABLE)
+    connection.execute(CREATE_TABLE_SQL)
+    count = 0
+    # 只查询需要的列，不构造 ORM 对象
+    posts = db.session.query(Post.id, Post.title, Post.body)
+    comments = db.session.query(Comment.id, Comment.body, Comment.post_id).filter_by(reviewed=True)
+    for query, row in ((posts, _post_row), (comments, _comment_row)):
+        rows = []
+        for obj in query.yield_per(chunk_size):
+            rows.append(row(obj))
+            if len(rows) >= chunk_size:
+                _write_rows(connection, [], rows)
+                count += len(rows)
+                rows = []
+        _write_rows(connection, [], rows)
+        count += len(rows)
+    db.session.commit()
+    return count
+
+
+class SearchResult(object):
+
+    def __init__(self, post_id, comment_id, title, snippet):
+        self.post_id = post_id
+        self.comment_id = comment_id
+        self.title = title
+        self.snippet = snippet
+
+
+def search(q, page, per_page):
+    match = build_match_query(q)
+    if not match:
+        return Pagination(None, page, per_page, 0, [])
+    connection = db.session.connection()
+    if not _index_ready(connection):
+        return _search_like(q, page, per_page)
+
+    total = connection.execute(db.text(
+        'SELECT count(*) FROM %s WHERE %s MATCH :match' % (FTS_TABLE, FTS_TABLE)), match=match).scalar()
+    rows = connection.execute(db.text(
+        'SELECT rowid, post_id, highlight({t}, 0, :open, :close) AS title, '
+        "snippet({t}, 1, :open, :close, '…', 48) AS snippet "
+        'FROM {t} WHERE {t} MATCH :match ORDER BY bm25({t}, 10.0, 1.0) '
+        'LIMIT :limit OFFSET :offset'.format(t=FTS_TABLE)),
+        match=match, open=HIGHLIGHT_OPEN, close=HIGHLIGHT_CLOSE,
+        limit=per_page, offset=(page - 1) * per_page).fetchall()
+
+    # 评论结果显示所属文章的标题
+    comment_post_ids = set(row.post_id for row in rows if row.rowid % 2)
+    titles = dict(db.session.query(Post.id, Post.title).filter(Post.id.in_(comment_post_ids))) \
+        if comment_post_ids else {}
+    items = []
+    for row in rows:
+        if row.rowid % 2:
+            items.append(SearchResult(row.post_id, row.rowid // 2, escape(titles.get(row.post_id, '')),
+                                      _highlight(row.snippet)))
+        else:
+            items.append(SearchResult(row.post_id, None, _highlight(row.title), _highlight(row.snippet)))
+    return Pagination(None, page, per_page, total, items)
+
+
+# 非 SQLite 数据库或尚未建立索引时退回 LIKE 查询，只搜索文章
+def _search_like(q, page, per_page):
+    query = Post.query
+    for term in q.split():
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        query = query.filter(or_(Post.title.like(pattern, escape='\\'), Post.body.like(pattern, escape='\\')))
+    pagination = query.order_by(Post.timestamp.desc()).paginate(page, per_page)
+    pagination.items = [SearchResult(post.id, None, escape(post.title),
+                                     escape(Markup(post.body or '').striptags()[:120]))
+                        for post in pagination.items]
+    return pagination
@@ -19,6 +19,8 @@ class BaseConfig(object):
     SQLALCHEMY_RECORD_QUERIES = True
 
     CKEDITOR_ENABLE_CSRF = True
+    # 固定编辑器语言，不再按浏览器语言加载语言包
+    CKEDITOR_LANGUAGE = 'zh-cn'
 
 
     MAIL_SEVER = os.getenv('MAIL_SERVER')
@@ -29,16 +31,104 @@ class BaseConfig(object):
     MAIL_DEFAULT_SENDER = ('Myblogs Admin', MAIL_USERNAME)
 
     MYBLOGS_EMAIL = os.getenv('MYBLOGS_EMAIL')
+    # 邮件发送线程数、队列长度、管理员通知合并窗口（秒，0 为不合并）和 SMTP 连接空闲关闭时间
+    MYBLOGS_MAIL_WORKERS = 2
+    MYBLOGS_MAIL_QUEUE_SIZE = 100
+    MYBLOGS_MAIL_DIGEST_WINDOW = 60
+    MYBLOGS_MAIL_IDLE_TIMEOUT = 30
+    # 邮件先写入 Outbox 表，由 flask outbox 命令在独立进程中发送
+    MYBLOGS_MAIL_OUTBOX = bool(os.getenv('MYBLOGS_MAIL_OUTBOX'))
+    MYBLOGS_OUTBOX_MAX_ATTEMPTS = 5
+    MYBLOGS_OUTBOX_RETRY_DELAY = 60
+    # 领取邮件的租期（秒），应大于发送一批邮件所需的时间
+    MYBLOGS_OUTBOX_LEASE = 300
     MYBLOGS_POST_PER_PAGE = 10
     MYBLOGS_MANAGE_POST_PER_PAGE = 15
     MYBLOGS_COMMENT_PER_PAGE = 15
+    # 批量审核、删除评论时每批处理的数量，每批一个事务
+    MYBLOGS_BULK_CHUNK_SIZE = 500
+    # 文章页按楼层显示评论和回复，回复最多展开的层数
+    MYBLOGS_THREADED_COMMENTS = True
+    MYBLOGS_COMMENT_MAX_DEPTH = 5
+    MYBLOGS_SEARCH_RESULT_PER_PAGE = 20
+    # 使用 ?before= / ?after= 游标分页，关闭后退回页码分页
+    MYBLOGS_KEYSET_PAGINATION = True
     # ('theme name', 'display name')
     MYBLOGS_THEMES = {'perfect_blue': '完美蓝', 'black_swan': '黑天鹅'}
+    # 超过该时间（秒）的查询记录到日志
     MYBLOGS_SLOW_QUERY_THRESHOLD = 1
+    # 在 Server-Timing 响应头中返回数据库耗时和查询次数
+    MYBLOGS_SERVER_TIMING = True
+    MYBLOGS_LOG_DIR = os.path.join(basedir, 'logs')
+
+    # 文件型 SQLite 的连接设置：WAL 模式下写入不阻塞读取，busy_timeout 让写入排队等待而不是
+    # 直接报 database is locked；mmap_size 和 cache_size（负数单位为 KiB）减少读盘
+    MYBLOGS_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+    }
+    # 连接池大小，0 为不使用连接池
+    MYBLOGS_SQLITE_POOL_SIZE = 5
+    MYBLOGS_SQLITE_MAX_OVERFLOW = 10
+    MYBLOGS_SQLITE_POOL_TIMEOUT = 30
+    # GET / HEAD 请求使用单独的只读连接
+    MYBLOGS_SQLITE_READ_ONLY = True
+
+    # 只读副本地址，多个用逗号分隔；这些蓝本的 GET / HEAD 请求轮流读副本
+    MYBLOGS_REPLICA_URLS = [url for url in os.getenv('MYBLOGS_REPLICA_URLS', '').split(',') if url]
+    MYBLOGS_READ_BLUEPRINTS = ['blog', 'admin']
+    # 出错的副本暂停使用的秒数
+    MYBLOGS_REPLICA_RETRY = 30
+    # 用户提交修改后继续读主库的秒数
+    MYBLOGS_REPLICA_STICKY = 10
 
     MYBLOGS_UPLOAD_PATH = os.path.join(basedir, 'uploads')
+    # 使用 flask assets 生成的打包文件（带哈希的文件名）及其缓存时间
+    MYBLOGS_ASSETS = True
+    MYBLOGS_ASSET_MAX_AGE = 365 * 24 * 3600
+    # 文章页和列表页边渲染边发送，攒够该字节数发送一次
+    MYBLOGS_STREAMING = True
+    MYBLOGS_STREAM_BUFFER = 8192
+    # flask export 生成的静态页面
+    MYBLOGS_EXPORT_DIR = os.path.join(basedir, 'export')
     MYBLOGS_ALLOWED_IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
 
+    # 'memory' 为进程内缓存，'filesystem' 可在多个 worker 之间共享
+    MYBLOGS_CACHE_TYPE = os.getenv('MYBLOGS_CACHE_TYPE', 'memory')
+    MYBLOGS_CACHE_DIR = os.path.join(basedir, 'cache')
+    MYBLOGS_CACHE_DEFAULT_TIMEOUT = 300
+    # 缓存的管理员资料的有效期。进程内缓存不能被 flask init 等命令清除，其他 worker 最多这么久后读到新的资料
+    MYBLOGS_ADMIN_CACHE_TIMEOUT = 60
+
+    # 匿名访问的整页缓存
+    MYBLOGS_PAGE_CACHE = True
+    MYBLOGS_PAGE_CACHE_TYPE = os.getenv('MYBLOGS_PAGE_CACHE_TYPE', 'memory')
+    MYBLOGS_PAGE_CACHE_DIR = os.path.join(basedir, 'page_cache')
+    # 页面缓存标签的版本号，文件缓存时放在单独的目录，不参与页面的数量限制
+    MYBLOGS_PAGE_TAG_DIR = os.path.join(basedir, 'page_tags')
+    MYBLOGS_PAGE_CACHE_SIZE = 1000
+    MYBLOGS_PAGE_CACHE_TIMEOUT = 600
+    # 公开页面返回 ETag / Last-Modified，支持 304
+    MYBLOGS_CONDITIONAL_GET = True
+
+    # 供 Prometheus 抓取的指标端点，需要 Authorization: Bearer <token>，没有设置令牌时返回 404
+    MYBLOGS_METRICS = True
+    MYBLOGS_METRICS_PATH = '/metrics'
+    MYBLOGS_METRICS_TOKEN = os.getenv('MYBLOGS_METRICS_TOKEN')
+
+    # 登录限流：维度 -> (令牌桶容量, 每隔多少秒补充一个令牌)，删除某个维度即不限制
+    MYBLOGS_LOGIN_LIMITS = {'ip': (10, 30), 'username': (20, 30)}
+    # 令牌桶保存在这个 SQLite 文件中，多个 worker 共享；为空时每个 worker 各自在内存中计数
+    MYBLOGS_THROTTLE_DB = os.getenv('MYBLOGS_THROTTLE_DB')
+    # 前面有几层负载均衡或反向代理，按这个层数从 X-Forwarded-For 取客户端地址；0 表示直接对外，不信任该请求头
+    MYBLOGS_PROXY_FIX_X_FOR = int(os.getenv('MYBLOGS_PROXY_FIX_X_FOR', 0))
+    # werkzeug 的密码哈希方法和迭代次数，修改后管理员下次登录时自动重新计算
+    MYBLOGS_PASSWORD_HASH_METHOD = 'pbkdf2:sha256:150000'
+
 
 #  开发环境配置
 class DevelopmentConfig(BaseConfig):
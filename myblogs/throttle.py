@@ -0,0 +1,127 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+
+# 令牌桶：容量 capacity，每 interval 秒补充一个令牌。返回 (剩余令牌, 需要等待的秒数)，
+# 等待时间为 0 表示本次允许并已扣除一个令牌
+def _take(tokens, updated, now, capacity, interval):
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + (now - updated) / interval)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, int(math.ceil((1 - tokens) * interval))
+
+
+# 进程内的令牌桶，每个 worker 各自计数；超过 max_size 个键时淘汰最久未使用的
+class MemoryBuckets(object):
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, interval):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (None, now))
+            tokens, wait = _take(tokens, updated, now, capacity, interval)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+# 保存在 SQLite 文件中的令牌桶，同一台机器上的多个 worker 共享计数。
+# BEGIN IMMEDIATE 先取得写锁，读取和更新之间不会被其他进程插入
+class SQLiteBuckets(object):
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._count = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 建表后关闭连接，各个 worker（可能是 fork 出来的进程）使用自己的连接
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+        connection.close()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, capacity, interval):
+        connection = self._connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, wait = _take(row[0] if row else None, row[1] if row else now, now, capacity, interval)
+            connection.execute('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                               (key, tokens, now))
+            # 定期删除已经补满的桶：没有记录和桶满的效果相同
+            self._count += 1
+            if self._count % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM bucket WHERE updated < ?', (now - capacity * interval,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def reset(self, key):
+        self._connect().execute('DELETE FROM bucket WHERE key = ?', (key,))
+
+
+# 按 MYBLOGS_LOGIN_LIMITS 中的维度（客户端 IP、用户名）限制登录尝试，
+# 在计算密码哈希之前检查，暴力破解不会占满 worker 的 CPU
+class Throttle(object):
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        path = app.config['MYBLOGS_THROTTLE_DB']
+        app.extensions['myblogs_throttle'] = SQLiteBuckets(path) if path else MemoryBuckets()
+
+    @property
+    def buckets(self):
+        return current_app.extensions['myblogs_throttle']
+
+    # 每个维度扣除一个令牌，返回需要等待的秒数，0 表示允许；没有配置的维度不限制
+    def hit(self, **keys):
+        limits = current_app.config['MYBLOGS_LOGIN_LIMITS']
+        for name, value in sorted(keys.items()):
+            if name not in limits:
+                continue
+            capacity, interval = limits[name]
+            wait = self.buckets.take('%s:%s' % (name, value), capacity, interval)
+            if wait:
+                return wait
+        return 0
+
+    # 登录成功后清除计数
+    def reset(self, **keys):
+        for name, value in keys.items():
+            self.buckets.reset('%s:%s' % (name, value))
@@ -3,7 +3,14 @@ try:
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
-from flask import request, redirect, url_for, current_app
+from flask import request, redirect, url_for, current_app, g, render_template, stream_with_context, \
+    before_render_template, template_rendered, get_flashed_messages
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
+
+# 模板中 stream_flush() 输出的标记，流式渲染时在这里把已渲染的内容发送出去
+STREAM_FLUSH = '<!-- flush -->'
 
 
 def is_safe_url(target):
@@ -24,3 +31,65 @@ def redirect_back(default='blog.index', **kwargs):
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in current_app.config['MYBLOGS_ALLOWED_IMAGE_EXTENSIONS']
+
+
+def stream_flush():
+    return Markup(STREAM_FLUSH) if g.get('streaming') else ''
+
+
+# 启用 MYBLOGS_STREAMING 时边渲染边发送：模板输出的片段攒够 MYBLOGS_STREAM_BUFFER 字节
+# 或遇到 stream_flush() 时发送一次，页面开头和正文不必等评论查询完成
+def render_stream(template_name, **context):
+    app = current_app._get_current_object()
+    if not app.config['MYBLOGS_STREAMING']:
+        return render_template(template_name, **context)
+
+    # 会话 cookie 随响应头发送，模板渲染时再修改会话不会保存：先取出闪现消息；
+    # 表单创建时已经生成了 CSRF 令牌，管理员的按钮直接调用 csrf_token()，也先生成
+    get_flashed_messages()
+    if current_user.is_authenticated:
+        generate_csrf()
+
+    g.streaming = True
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    buffer_size = app.config['MYBLOGS_STREAM_BUFFER']
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        buffer, size = [], 0
+        for chunk in template.generate(context):
+            if chunk != STREAM_FLUSH:
+                buffer.append(chunk)
+                size += len(chunk)
+                if size < buffer_size:
+                    continue
+            if buffer:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+        template_rendered.send(app, template=template, context=context)
+
+    return app.response_class(stream_with_context(generate()))
+
+
+# 响应内容生成完毕后调用 func。流式响应的查询和模板渲染发生在 after_request 之后，
+# 这里包一层仍在请求上下文中的生成器，最后一段内容发出后（或客户端断开时）再调用；
+# 普通响应和直接传递文件的响应立即调用
+def after_response(response, func):
+    if not response.is_streamed or response.direct_passthrough:
+        func()
+        return response
+
+    def finish(chunks):
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            func()
+
+    response.response = stream_with_context(finish(response.response))
+    return response
@@ -0,0 +1,45 @@
+import pytest
+
+from myblogs import create_app, fakes
+from myblogs.extensions import db
+from myblogs.models import Admin, rebuild_counters
+
+PASSWORD = 'secret123'
+
+
+# 内存数据库，固定随机种子生成虚拟数据；关闭页面缓存和流式渲染，每个请求都完整执行查询
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_RECORD_QUERIES=True,
+                      MYBLOGS_PAGE_CACHE=False, MYBLOGS_CONDITIONAL_GET=False, MYBLOGS_STREAMING=False)
+    with app.app_context():
+        db.create_all()
+        fakes.seed(1)
+        fakes.fake_admin()
+        fakes.fake_categories(5)
+        fakes.fake_posts(60)
+        fakes.fake_comments(600)
+        rebuild_counters()
+        Admin.query.first().set_password(PASSWORD)
+        db.session.commit()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def password():
+    return PASSWORD
+
+
+@pytest.fixture
+def admin_client(client):
+    username = Admin.query.first().username
+    client.post('/auth/login', data=dict(username=username, password=PASSWORD))
+    return client
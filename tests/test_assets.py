@@ -0,0 +1,97 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+import pytest
+from flask import url_for
+
+from myblogs.assets import MANIFEST, Assets, brotli, build_assets, bundles, prune_assets
+
+
+# 把打包用到的源文件复制到临时的 static 目录，不改动项目中的 static/dist
+@pytest.fixture
+def manifest(app, tmp_path):
+    static = tmp_path / 'static'
+    for sources in bundles(app).values():
+        for source in sources:
+            os.makedirs(str(static / os.path.dirname(source)), exist_ok=True)
+            shutil.copy(os.path.join(app.static_folder, source), str(static / source))
+    app.static_folder = str(static)
+    manifest = build_assets(app)
+    Assets.set_manifest(app, manifest)
+    return manifest
+
+
+def _read(app, filename):
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        return f.read()
+
+
+# 文件名中的哈希由内容得到，重复打包结果不变
+def test_manifest_fingerprints(app, manifest):
+    assert set(manifest) == set(bundles(app))
+    for name, filename in manifest.items():
+        base, ext = os.path.splitext(name)
+        data = _read(app, filename)
+        assert filename == 'dist/%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:12], ext)
+    assert json.loads(_read(app, MANIFEST).decode('utf-8')) == manifest
+    assert build_assets(app) == manifest
+
+
+# CSS 和 JS 有内容相同的 gzip / brotli 版本，图标不压缩
+def test_compressed_siblings(app, manifest):
+    for name, filename in manifest.items():
+        path = os.path.join(app.static_folder, filename)
+        if name == 'favicon.ico':
+            assert not os.path.exists(path + '.gz') and not os.path.exists(path + '.br')
+            continue
+        assert gzip.decompress(_read(app, filename + '.gz')) == _read(app, filename)
+        if brotli is None:
+            assert not os.path.exists(path + '.br')
+        else:
+            assert brotli.decompress(_read(app, filename + '.br')) == _read(app, filename)
+
+
+# url_for('static') 返回带哈希的文件名，不在清单中的文件不变
+def test_url_defaults_use_manifest(app, client, manifest):
+    with app.test_request_context():
+        assert url_for('static', filename='js/base.js') == '/static/' + manifest['js/base.js']
+        assert url_for('static', filename='css/style.css') == '/static/css/style.css'
+    html = client.get('/').get_data(as_text=True)
+    assert manifest['js/base.js'] in html and manifest['css/perfect_blue.css'] in html
+    assert 'js/script.js' not in html
+
+
+# 带哈希的文件返回预压缩版本并允许永久缓存
+def test_hashed_files_are_immutable(app, client, manifest):
+    filename = manifest['css/perfect_blue.css']
+    response = client.get('/static/' + filename, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.mimetype == 'text/css'
+    assert gzip.decompress(response.get_data()) == _read(app, filename)
+    assert 'immutable' in response.headers['Cache-Control']
+    assert 'max-age=%d' % app.config['MYBLOGS_ASSET_MAX_AGE'] in response.headers['Cache-Control']
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    response = client.get('/static/' + filename)
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == _read(app, filename)
+    assert 'immutable' in response.headers['Cache-Control']
+
+    response = client.get('/static/css/style.css')
+    assert response.status_code == 200
+    assert 'immutable' not in response.headers.get('Cache-Control', '')
+
+
+# 删除不在清单中的旧版本及其压缩文件
+def test_prune_assets(app, manifest):
+    old = os.path.join(app.static_folder, 'dist', 'css', 'perfect_blue.000000000000.css')
+    for suffix in ('', '.gz'):
+        with open(old + suffix, 'w') as f:
+            f.write('old')
+    assert prune_assets(app, manifest) == 2
+    assert not os.path.exists(old)
+    for filename in manifest.values():
+        assert os.path.exists(os.path.join(app.static_folder, filename))
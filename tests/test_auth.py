@@ -0,0 +1,90 @@
+import pytest
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from myblogs import create_app
+from myblogs.extensions import cache, db
+from myblogs.models import Admin
+from myblogs.settings import TestingConfig
+
+
+def _login(client, username, ip):
+    return client.post('/auth/login', data=dict(username=username, password='wrong-password'),
+                       headers={'X-Forwarded-For': ip}, environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+
+@pytest.fixture
+def proxied_app(monkeypatch):
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_PROXY_FIX_X_FOR', 1)
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', MYBLOGS_LOGIN_LIMITS={'ip': (1, 60)})
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+# 经过一层代理时按 X-Forwarded-For 中的客户端地址限流，而不是代理的地址
+def test_login_throttle_uses_forwarded_address(proxied_app):
+    client = proxied_app.test_client()
+    assert _login(client, 'a', '1.2.3.4').status_code == 200
+    assert _login(client, 'b', '1.2.3.4').status_code == 429
+    assert _login(client, 'c', '5.6.7.8').status_code == 200
+
+
+# 没有配置代理层数时不信任 X-Forwarded-For
+def test_forwarded_header_ignored_by_default(app, client):
+    app.config['MYBLOGS_LOGIN_LIMITS'] = {'ip': (1, 60)}
+    assert _login(client, 'a', '1.2.3.4').status_code == 200
+    assert _login(client, 'b', '5.6.7.8').status_code == 429
+
+
+# flask init 修改管理员后删除共享缓存中的 'admin'，其他 worker 下次请求重新读取
+def test_init_clears_shared_admin_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % (tmp_path / 'data.db'),
+                        raising=False)
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_CACHE_TYPE', 'filesystem')
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_CACHE_DIR', str(tmp_path / 'cache'))
+    worker, cli = create_app('testing'), create_app('testing')
+    runner = cli.test_cli_runner()
+    assert runner.invoke(args=['init', '--username', 'old', '--password', 'secret123']).exit_code == 0
+
+    with worker.app_context():
+        assert worker.test_client().get('/about').status_code == 200
+        assert cache.get('admin')['username'] == 'old'
+    result = runner.invoke(args=['init', '--username', 'new', '--password', 'secret456'])
+    assert result.exit_code == 0 and '最多' not in result.output
+    with worker.app_context():
+        assert cache.get('admin') is None
+
+
+# 提交后再回滚会话：哈希已经写入数据库，而不只是留在会话中
+def _stored_hash():
+    db.session.rollback()
+    return db.session.query(Admin.password_hash).scalar()
+
+
+# 旧参数生成的哈希在登录成功后按 MYBLOGS_PASSWORD_HASH_METHOD 重新计算并提交
+def test_login_rehashes_old_password(app, client, password):
+    admin = Admin.query.first()
+    admin.password_hash = generate_password_hash(password, 'pbkdf2:sha1:1000')
+    db.session.commit()
+    old = _stored_hash()
+
+    client.post('/auth/login', data=dict(username=admin.username, password='wrong-password'))
+    assert _stored_hash() == old
+
+    response = client.post('/auth/login', data=dict(username=admin.username, password=password))
+    assert response.status_code == 302
+    stored = _stored_hash()
+    assert stored.startswith(app.config['MYBLOGS_PASSWORD_HASH_METHOD'] + '$')
+    assert check_password_hash(stored, password)
+
+
+# 哈希参数没有变化时登录不改写密码
+def test_login_keeps_current_hash(app, client, password):
+    old = _stored_hash()
+    assert old.startswith(app.config['MYBLOGS_PASSWORD_HASH_METHOD'] + '$')
+    response = client.post('/auth/login', data=dict(username=Admin.query.first().username, password=password))
+    assert response.status_code == 302
+    assert _stored_hash() == old
@@ -0,0 +1,217 @@
+import pytest
+from sqlalchemy import event
+
+from myblogs.bulk import approve_comments, delete_comments, delete_posts, move_posts, set_can_comment
+from myblogs.extensions import db
+from myblogs.models import Category, Comment, Post
+from myblogs.search import FTS_TABLE, rebuild_index
+
+
+# 先重建全文索引，之后每次批量操作后索引都应与数据一致
+@pytest.fixture
+def indexed(app):
+    rebuild_index()
+    db.session.commit()
+    return app
+
+
+# 记录提交次数，用于检查分批提交
+@pytest.fixture
+def commits(app):
+    count = []
+
+    def record(session):
+        count.append(1)
+    event.listen(db.session(), 'after_commit', record)
+    yield count
+    event.remove(db.session(), 'after_commit', record)
+
+
+# 计数与实际数量一致，没有孤立的评论，全文索引只包含文章和已审核的评论
+def _assert_consistent():
+    db.session.expire_all()
+    for post in Post.query:
+        comments = Comment.query.filter_by(post_id=post.id)
+        assert post.comment_count == comments.count()
+        assert post.reviewed_comment_count == comments.filter_by(reviewed=True).count()
+    for category in Category.query:
+        assert category.post_count == Post.query.filter_by(category_id=category.id).count()
+
+    post_ids = db.session.query(Post.id)
+    assert Comment.query.filter(db.or_(Comment.post_id == None, ~Comment.post_id.in_(post_ids))).count() == 0
+    comment_ids = db.session.query(Comment.id)
+    assert Comment.query.filter(Comment.replied_id != None, ~Comment.replied_id.in_(comment_ids)).count() == 0
+
+    rowids = set(rowid for (rowid,) in db.session.execute('SELECT rowid FROM %s' % FTS_TABLE))
+    expected = set(post_id * 2 for (post_id,) in post_ids)
+    expected.update(comment_id * 2 + 1 for (comment_id,) in comment_ids.filter(Comment.reviewed == True))
+    assert rowids == expected
+
+
+# 评论 id -> 它和它的全部回复
+def _subtrees():
+    children = {}
+    for comment_id, replied_id in db.session.query(Comment.id, Comment.replied_id):
+        children.setdefault(replied_id, []).append(comment_id)
+
+    def walk(comment_id):
+        result = {comment_id}
+        for child in children.get(comment_id, ()):
+            result |= walk(child)
+        return result
+    return dict((comment_id, walk(comment_id)) for (comment_id,) in db.session.query(Comment.id))
+
+
+def test_approve_comments_in_chunks(indexed, commits):
+    indexed.config['MYBLOGS_BULK_CHUNK_SIZE'] = 7
+    pending = Comment.query.filter_by(reviewed=False).count()
+    assert pending > 7
+    assert approve_comments(db.true()) == pending
+    assert len(commits) == -(-pending // 7)
+    assert Comment.query.filter_by(reviewed=False).count() == 0
+    _assert_consistent()
+
+
+# 分批删除评论，每条评论的多层回复一起删除
+def test_delete_comments_removes_reply_subtree(indexed):
+    indexed.config['MYBLOGS_BULK_CHUNK_SIZE'] = 2
+    subtrees = _subtrees()
+    deepest = max(subtrees, key=lambda comment_id: len(subtrees[comment_id]))
+    assert len(subtrees[deepest]) > 2
+    others = sorted(comment_id for comment_id in subtrees if comment_id not in subtrees[deepest])[:3]
+    removed = set(subtrees[deepest]).union(*(subtrees[comment_id] for comment_id in others))
+
+    selected, deleted = delete_comments(Comment.id.in_([deepest] + others))
+    assert selected == 4 and deleted == len(removed)
+    assert Comment.query.filter(Comment.id.in_(removed)).count() == 0
+    _assert_consistent()
+
+
+@pytest.mark.parametrize('rule, criterion', [
+    ('unread', Comment.reviewed == False),
+    ('admin', Comment.from_admin == True),
+    ('all', db.true()),
+])
+def test_batch_approve_all(indexed, admin_client, rule, criterion):
+    indexed.config['MYBLOGS_BULK_CHUNK_SIZE'] = 50
+    pending = Comment.query.filter(criterion, Comment.reviewed == False).count()
+    response = admin_client.post('/admin/comment/batch', data=dict(action='approve-all', filter=rule),
+                                 follow_redirects=True)
+    assert '批准了 %d 条评论' % pending in response.get_data(as_text=True)
+    assert Comment.query.filter(criterion, Comment.reviewed == False).count() == 0
+    _assert_consistent()
+
+
+@pytest.mark.parametrize('rule, criterion', [
+    ('unread', Comment.reviewed == False),
+    ('admin', Comment.from_admin == True),
+    ('all', db.true()),
+])
+def test_batch_delete_all(indexed, admin_client, rule, criterion):
+    indexed.config['MYBLOGS_BULK_CHUNK_SIZE'] = 50
+    subtrees = _subtrees()
+    removed = set().union(*(subtrees[comment_id] for (comment_id,) in db.session.query(Comment.id).filter(criterion)))
+    assert removed
+    response = admin_client.post('/admin/comment/batch', data=dict(action='delete-all', filter=rule),
+                                 follow_redirects=True)
+    assert '删除了 %d 条评论' % len(removed) in response.get_data(as_text=True)
+    assert Comment.query.filter(criterion).count() == 0
+    assert Comment.query.count() == len(subtrees) - len(removed)
+    _assert_consistent()
+
+
+def test_batch_selected_ids(indexed, admin_client):
+    ids = [comment_id for (comment_id,) in
+           db.session.query(Comment.id).filter_by(reviewed=False).order_by(Comment.id).limit(3)]
+    admin_client.post('/admin/comment/batch', data=dict(action='approve', ids=ids))
+    assert Comment.query.filter(Comment.id.in_(ids), Comment.reviewed == True).count() == 3
+    response = admin_client.post('/admin/comment/batch', data=dict(action='delete'), follow_redirects=True)
+    assert '请先选择评论' in response.get_data(as_text=True)
+    _assert_consistent()
+
+
+# 评论最多的几篇文章，分布在不同分类中
+def _busy_posts(count=4):
+    return [post_id for (post_id,) in db.session.query(Post.id).order_by(Post.comment_count.desc(), Post.id)
+            .limit(count)]
+
+
+def test_move_posts(indexed):
+    ids = _busy_posts()
+    target = Category.query.get(2)
+    moving = Post.query.filter(Post.id.in_(ids), Post.category_id != target.id).count()
+    assert moving > 0
+    comments = Comment.query.count()
+    assert move_posts(ids, target) == moving
+    assert Post.query.filter(Post.id.in_(ids), Post.category_id != target.id).count() == 0
+    assert Comment.query.count() == comments
+    _assert_consistent()
+
+
+def test_delete_posts(indexed):
+    ids = _busy_posts()
+    posts = Post.query.count()
+    assert delete_posts(ids + [10 ** 6]) == len(ids)
+    assert Post.query.count() == posts - len(ids)
+    assert Comment.query.filter(Comment.post_id.in_(ids)).count() == 0
+    _assert_consistent()
+
+
+def test_set_can_comment(indexed):
+    ids = _busy_posts()
+    Post.query.get(ids[0]).can_comment = False
+    db.session.commit()
+    assert set_can_comment(ids, False) == len(ids) - 1
+    assert Post.query.filter(Post.id.in_(ids), Post.can_comment == True).count() == 0
+    assert set_can_comment(ids, True) == len(ids)
+    _assert_consistent()
+
+
+@pytest.mark.parametrize('action, expected', [
+    ('move', '篇文章移至'),
+    ('delete', '删除了 4 篇文章'),
+    ('close-comments', '4 篇文章的评论功能已关闭'),
+])
+def test_batch_posts(indexed, admin_client, action, expected):
+    response = admin_client.post('/admin/post/batch', data=dict(action=action, ids=_busy_posts(), category_id=3),
+                                 follow_redirects=True)
+    assert expected in response.get_data(as_text=True)
+    _assert_consistent()
+
+
+# 删除分类时文章移到默认分类，评论保持不变
+def test_delete_category(indexed, admin_client):
+    category = Category.query.get(3)
+    moved = category.post_count
+    assert moved > 0
+    default = Category.query.get(1).post_count
+    comments = Comment.query.count()
+    response = admin_client.post('/admin/category/3/delete', follow_redirects=True)
+    assert '%d 篇文章移至默认类别' % moved in response.get_data(as_text=True)
+    assert Category.query.get(3) is None
+    assert Category.query.get(1).post_count == default + moved
+    assert Comment.query.count() == comments
+    _assert_consistent()
+
+
+def test_merge_category(indexed, admin_client):
+    source, target = Category.query.get(4), Category.query.get(5)
+    moved, count = source.post_count, target.post_count
+    assert moved > 0
+    response = admin_client.post('/admin/category/4/merge', data=dict(target_id=5), follow_redirects=True)
+    assert '移动了 %d 篇文章' % moved in response.get_data(as_text=True)
+    assert Category.query.get(4) is None and Category.query.get(5).post_count == count + moved
+    _assert_consistent()
+
+    response = admin_client.post('/admin/category/5/merge', data=dict(target_id=5), follow_redirects=True)
+    assert '请选择另一个类别' in response.get_data(as_text=True)
+    assert Category.query.get(5) is not None
+
+
+def test_category_delete_to_target(indexed):
+    source, target = Category.query.get(2), Category.query.get(3)
+    ids = [post_id for (post_id,) in db.session.query(Post.id).filter_by(category_id=2)]
+    moved = source.post_count
+    assert source.delete(target) == moved == len(ids)
+    assert Post.query.filter(Post.id.in_(ids), Post.category_id == 3).count() == len(ids)
+    _assert_consistent()
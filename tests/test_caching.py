@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+from myblogs.extensions import cache, db, page_cache
+from myblogs.models import Category, Comment, Post
+from myblogs.settings import TestingConfig
+
+
+def _purged(*tags):
+    before = dict((tag, page_cache._tag_version(tag)) for tag in tags)
+
+    def check():
+        return set(tag for tag in tags if page_cache._tag_version(tag) != before[tag])
+    return check
+
+
+# 未审核的评论只改动计数和 updated，不失效首页和分类页
+def test_unreviewed_comment_purges_only_post(app):
+    post = Post.query.first()
+    purged = _purged('posts', 'post:%d' % post.id)
+    db.session.add(Comment(author='a', email='a@example.com', body='hi', post=post))
+    db.session.commit()
+    assert purged() == {'post:%d' % post.id}
+
+
+def test_reviewed_comment_purges_listing(app):
+    post = Post.query.first()
+    purged = _purged('posts', 'post:%d' % post.id)
+    db.session.add(Comment(author='a', email='a@example.com', body='hi', post=post, reviewed=True))
+    db.session.commit()
+    assert purged() == {'posts', 'post:%d' % post.id}
+
+
+def test_post_listing_columns(app):
+    post = Post.query.first()
+    purged = _purged('posts')
+    post.can_comment = not post.can_comment
+    db.session.commit()
+    assert not purged()
+    post.title = 'changed'
+    db.session.commit()
+    assert purged() == {'posts'}
+
+
+def test_moving_post_purges_listing(app):
+    post = Post.query.first()
+    category = Category.query.filter(Category.id != post.category_id).first()
+    purged = _purged('posts')
+    post.category = category
+    db.session.commit()
+    assert purged() == {'posts'}
+
+
+# 缓存的管理员不含密码哈希，登录时从数据库读取
+def test_cached_admin_excludes_password_hash(app, admin_client, password):
+    assert admin_client.get('/admin/settings').status_code == 200
+    data = cache.get('admin')
+    assert data is not None and 'password_hash' not in data
+    admin_client.get('/auth/logout')
+    response = admin_client.post('/auth/login', data=dict(username=data['username'], password=password))
+    assert response.status_code == 302
+    assert admin_client.get('/admin/settings').status_code == 200
+
+
+@pytest.fixture
+def filesystem_pages(monkeypatch, tmp_path):
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_PAGE_CACHE_TYPE', 'filesystem')
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_PAGE_CACHE_DIR', str(tmp_path / 'pages'))
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_PAGE_TAG_DIR', str(tmp_path / 'tags'))
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_PAGE_CACHE_SIZE', 2)
+
+
+# 页面数超过上限时只淘汰页面，标签版本号不变，其他页面不会因此失效
+def test_pruning_pages_keeps_tag_versions(filesystem_pages, app, client):
+    app.config['MYBLOGS_PAGE_CACHE'] = True
+    purged = _purged('site', 'posts')
+    for post in Post.query.limit(5):
+        assert client.get('/post/%d' % post.id).headers['X-Page-Cache'] == 'MISS'
+    assert len(os.listdir(app.config['MYBLOGS_PAGE_CACHE_DIR'])) <= 2
+    assert not purged()
+
+
+def _conditional_get(app, client, url, **headers):
+    app.config['MYBLOGS_CONDITIONAL_GET'] = True
+    return client.get(url, headers=headers)
+
+
+def test_if_none_match_returns_304(app, client):
+    post = Post.query.first()
+    url = '/post/%d' % post.id
+    response = _conditional_get(app, client, url)
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and etag
+    response = _conditional_get(app, client, url, **{'If-None-Match': etag})
+    assert response.status_code == 304 and response.headers['ETag'] == etag
+
+
+def test_if_modified_since_returns_304(app, client):
+    response = _conditional_get(app, client, '/')
+    last_modified = response.headers['Last-Modified']
+    assert _conditional_get(app, client, '/', **{'If-Modified-Since': last_modified}).status_code == 304
+
+
+# 文章修改后 ETag 改变，旧的 ETag 不再返回 304
+def test_changed_post_changes_etag(app, client):
+    post = Post.query.first()
+    url = '/post/%d' % post.id
+    etag = _conditional_get(app, client, url).headers['ETag']
+    post.title = 'changed'
+    db.session.commit()
+    response = _conditional_get(app, client, url, **{'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from myblogs.extensions import db
+from myblogs.models import Category, Comment, Post
+from myblogs.queries import comment_thread, thread_roots
+
+
+# r1 下面有三层回复，r2 的回复未审核，r3 未审核但它的回复已审核，单独成为一个楼层
+@pytest.fixture
+def thread(app):
+    start = datetime(2020, 1, 1)
+    post = Post(title='thread', body='<p>thread</p>', category=Category.query.first())
+    comments = {}
+
+    def add(name, minutes, replied=None, reviewed=True):
+        comments[name] = Comment(author=name, email='%s@example.com' % name, body=name, post=post,
+                                 replied=comments.get(replied), reviewed=reviewed,
+                                 timestamp=start + timedelta(minutes=minutes))
+
+    add('r1', 1)
+    add('a', 2, 'r1')
+    add('b', 3, 'r1')
+    add('a1', 4, 'a')
+    add('a1x', 5, 'a1')
+    add('r2', 6)
+    add('u', 7, 'r2', reviewed=False)
+    add('r3', 8, reviewed=False)
+    add('c', 9, 'r3')
+    db.session.add(post)
+    db.session.commit()
+    return post, comments
+
+
+def _thread(post, max_depth):
+    roots = thread_roots(post).order_by(Comment.timestamp, Comment.id).all()
+    return [(comment.author, depth, more) for comment, depth, more in comment_thread(roots, max_depth)]
+
+
+# 回复紧跟在被回复的评论后面，同一层按时间排序
+def test_thread_nesting_order(thread):
+    post, comments = thread
+    assert _thread(post, 5) == [('r1', 0, False), ('a', 1, False), ('a1', 2, False), ('a1x', 3, False),
+                                ('b', 1, False), ('r2', 0, False), ('c', 0, False)]
+
+
+# 超过最大层数的回复不展开，由上一层显示“查看更多回复”
+def test_thread_max_depth_cutoff(thread):
+    post, comments = thread
+    assert _thread(post, 1) == [('r1', 0, False), ('a', 1, True), ('b', 1, False),
+                                ('r2', 0, False), ('c', 0, False)]
+    assert _thread(post, 2) == [('r1', 0, False), ('a', 1, False), ('a1', 2, True), ('b', 1, False),
+                                ('r2', 0, False), ('c', 0, False)]
+
+
+def test_more_link_shows_deeper_replies(app, client, thread):
+    post, comments = thread
+    app.config['MYBLOGS_COMMENT_MAX_DEPTH'] = 1
+    html = client.get('/post/%d' % post.id).get_data(as_text=True)
+    link = '/post/%d?thread=%d#comments' % (post.id, comments['a'].id)
+    assert link in html and 'id="comment-%d"' % comments['a1'].id not in html
+
+    html = client.get('/post/%d?thread=%d' % (post.id, comments['a'].id)).get_data(as_text=True)
+    assert 'id="comment-%d"' % comments['a1'].id in html
+    assert 'id="comment-%d"' % comments['r1'].id not in html
+
+
+# “最新评论”链接指向最后一页楼层
+def test_latest_link_shows_last_page(app, client, thread):
+    post, comments = thread
+    app.config['MYBLOGS_COMMENT_PER_PAGE'] = 1
+    html = client.get('/post/%d' % post.id).get_data(as_text=True)
+    assert '/post/%d?before=#comments' % post.id in html
+    assert 'id="comment-%d"' % comments['r1'].id in html
+
+    html = client.get('/post/%d?before=' % post.id).get_data(as_text=True)
+    assert 'id="comment-%d"' % comments['c'].id in html
+    assert 'id="comment-%d"' % comments['r1'].id not in html
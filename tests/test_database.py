@@ -0,0 +1,176 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from myblogs import create_app, fakes
+from myblogs.extensions import db
+from myblogs.models import Category, Post, rebuild_counters
+from myblogs.settings import TestingConfig
+
+
+def _pragma(engine, name):
+    with engine.connect() as connection:
+        return connection.execute('PRAGMA %s' % name).scalar()
+
+
+@pytest.fixture
+def file_app(monkeypatch, tmp_path):
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % (tmp_path / 'data.db'),
+                        raising=False)
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+
+
+# 文件型 SQLite 使用连接池，每个连接都执行 MYBLOGS_SQLITE_PRAGMAS
+def test_file_sqlite_pragmas_and_pool(file_app):
+    engine = db.engine
+    assert isinstance(engine.pool, QueuePool)
+    assert engine.pool.size() == file_app.config['MYBLOGS_SQLITE_POOL_SIZE']
+    assert _pragma(engine, 'journal_mode') == 'wal'
+    assert _pragma(engine, 'busy_timeout') == file_app.config['MYBLOGS_SQLITE_PRAGMAS']['busy_timeout']
+    assert _pragma(engine, 'synchronous') == 1
+    assert _pragma(engine, 'query_only') == 0
+
+
+# GET 请求使用的只读引擎是另一个连接池，连接设置了 query_only
+def test_read_engine_is_query_only(file_app):
+    read_engine = db.get_read_engine(file_app)
+    assert read_engine is not db.engine
+    assert isinstance(read_engine.pool, QueuePool)
+    assert _pragma(read_engine, 'query_only') == 1
+    assert _pragma(read_engine, 'journal_mode') == 'wal'
+
+
+def test_pool_size_zero_keeps_default_pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_SQLITE_POOL_SIZE', 0)
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % (tmp_path / 'data.db'),
+                        raising=False)
+    app = create_app('testing')
+    with app.app_context():
+        assert not isinstance(db.engine.pool, QueuePool)
+        assert _pragma(db.engine, 'journal_mode') == 'wal'
+
+
+# 内存数据库保持 Flask-SQLAlchemy 的 StaticPool，不设置 PRAGMA，也没有只读引擎
+def test_memory_sqlite_keeps_default_pool(app):
+    assert isinstance(db.engine.pool, StaticPool)
+    assert _pragma(db.engine, 'journal_mode') == 'memory'
+    assert db.get_read_engine(app) is None
+
+
+def _replicated_app(monkeypatch, tmp_path, replicas):
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', 'sqlite:///%s' % (tmp_path / 'primary.db'),
+                        raising=False)
+    monkeypatch.setattr(TestingConfig, 'MYBLOGS_REPLICA_URLS', ['sqlite:///%s' % path for path in replicas])
+    app = create_app('testing')
+    app.config.update(MYBLOGS_PAGE_CACHE=False, MYBLOGS_CONDITIONAL_GET=False, MYBLOGS_STREAMING=False)
+    return app
+
+
+# 记录每条 SQL 在哪个数据库文件上执行
+def _track(engines):
+    used = []
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute',
+                     lambda conn, *args: used.append(os.path.basename(conn.engine.url.database)))
+    return used
+
+
+# 主库和一个副本都是本地 SQLite 文件，副本由 flask replicate 复制得到
+@pytest.fixture
+def replicated_app(monkeypatch, tmp_path):
+    app = _replicated_app(monkeypatch, tmp_path, [tmp_path / 'replica.db'])
+    with app.app_context():
+        db.create_all()
+        fakes.seed(1)
+        fakes.fake_admin()
+        fakes.fake_categories(2)
+        fakes.fake_posts(5)
+        rebuild_counters()
+        db.session.commit()
+        result = app.test_cli_runner().invoke(args=['replicate'])
+        assert result.exit_code == 0 and 'replica0' in result.output
+        yield app
+        db.session.remove()
+
+
+def test_replicate_copies_primary(replicated_app):
+    engine = db.get_engine(replicated_app, bind='replica0')
+    with engine.connect() as connection:
+        assert connection.execute('SELECT count(*) FROM post').scalar() == 5
+
+
+# GET 请求读副本：只在主库里的文章在副本上找不到
+def test_get_reads_replica(replicated_app):
+    post = Post(title='primary only', body='<p>new</p>', category=Category.query.first())
+    db.session.add(post)
+    db.session.commit()
+    post_id = post.id
+    # 测试和请求共用一个会话，清空标识映射，请求里重新查询
+    db.session.remove()
+    used = _track([db.engine, db.get_engine(replicated_app, bind='replica0')])
+
+    client = replicated_app.test_client()
+    assert client.get('/').status_code == 200
+    assert used and set(used) == {'replica.db'}
+    assert client.get('/post/%d' % post_id).status_code == 404
+
+
+# POST 请求和提交后的跳转都读主库，新评论立即可见
+def test_post_and_sticky_read_use_primary(replicated_app):
+    post = Post.query.first()
+    used = _track([db.engine, db.get_engine(replicated_app, bind='replica0')])
+
+    client = replicated_app.test_client()
+    response = client.post('/post/%d' % post.id, data=dict(author='a', email='a@example.com', body='hi'),
+                           follow_redirects=True)
+    assert response.status_code == 200
+    assert used and set(used) == {'primary.db'}
+
+    del used[:]
+    assert client.get('/').status_code == 200
+    assert used and set(used) == {'primary.db'}
+
+    # 另一个用户不受影响，仍然读副本
+    del used[:]
+    assert replicated_app.test_client().get('/').status_code == 200
+    assert used and set(used) == {'replica.db'}
+
+
+# 副本无法连接时标记为不可用，查询改用其他副本或主库
+def test_missing_replica_falls_back(monkeypatch, tmp_path):
+    app = _replicated_app(monkeypatch, tmp_path, [tmp_path / 'missing' / 'replica.db'])
+    with app.app_context():
+        db.create_all()
+        fakes.fake_admin()
+        fakes.fake_categories(1)
+        db.session.commit()
+        used = _track([db.engine])
+        assert app.test_client().get('/').status_code == 200
+        assert used and set(used) == {'primary.db'}
+        replicas = app.extensions['myblogs_replicas']
+        assert replicas._down_until['replica0'] > time.time()
+        db.session.remove()
+
+
+def test_down_replica_is_skipped(monkeypatch, tmp_path):
+    app = _replicated_app(monkeypatch, tmp_path, [tmp_path / 'missing' / 'replica.db', tmp_path / 'replica.db'])
+    with app.app_context():
+        db.create_all()
+        fakes.fake_admin()
+        fakes.fake_categories(1)
+        db.session.commit()
+        assert app.test_cli_runner().invoke(args=['replicate']).exit_code == 0
+        used = _track([db.engine, db.get_engine(app, bind='replica1')])
+        client = app.test_client()
+        for i in range(3):
+            assert client.get('/').status_code == 200
+        assert used and set(used) == {'replica.db'}
+        assert 'replica0' not in app.extensions['myblogs_replicas']._healthy
+        db.session.remove()
@@ -0,0 +1,217 @@
+import socket
+import socketserver
+import threading
+
+import pytest
+from flask_mail import Message
+
+from myblogs import emails
+from myblogs.emails import MailDispatcher, _deliver
+from myblogs.extensions import db
+from myblogs.models import Comment, Post
+
+
+# 最简单的 SMTP 服务器：记录每封邮件来自第几个连接，drop() 断开所有连接
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        self.connections = []
+        self.accepted = 0
+        self.messages = []
+        self.lock = threading.Lock()
+        super(SMTPStub, self).__init__(('127.0.0.1', 0), SMTPHandler)
+
+    def drop(self):
+        with self.lock:
+            handlers, self.connections = self.connections, []
+        for handler in handlers:
+            handler.request.shutdown(socket.SHUT_RDWR)
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections.append(self)
+            self.server.accepted += 1
+            self.number = self.server.accepted
+        self.reply('220 stub')
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply('354 go ahead')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    self.server.messages.append((self.number, b''.join(data).decode('utf-8')))
+                self.reply('250 ok')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            elif command == b'EHLO':
+                self.reply('250 stub')
+            else:
+                self.reply('250 ok')
+
+    def reply(self, text):
+        try:
+            self.wfile.write(text.encode('ascii') + b'\r\n')
+        except OSError:
+            pass
+
+
+@pytest.fixture
+def smtp(app):
+    server = SMTPStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    state = app.extensions['mail']
+    state.server, state.port = server.server_address
+    state.use_ssl = state.use_tls = False
+    state.suppress = False
+    state.username = state.password = None
+    state.default_sender = 'blog@example.com'
+    app.config.update(MYBLOGS_EMAIL='admin@example.com', MYBLOGS_MAIL_WORKERS=1)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatcher(app, smtp):
+    dispatcher = MailDispatcher(app)
+    yield dispatcher
+    dispatcher.shutdown()
+
+
+def _message(subject):
+    return Message(subject, recipients=['reader@example.com'], html='<p>%s</p>' % subject)
+
+
+def _connections(smtp):
+    return len(set(number for number, data in smtp.messages))
+
+
+# 同一个发送线程复用一个 SMTP 连接
+def test_connection_is_reused(dispatcher, smtp):
+    for i in range(3):
+        assert dispatcher.submit(_message('m%d' % i))
+    dispatcher.queue.join()
+    assert len(smtp.messages) == 3 and _connections(smtp) == 1
+    assert dispatcher.stats['sent'] == 3
+
+
+# 服务器断开连接后重新连接，邮件不丢失
+def test_reconnects_after_disconnect(dispatcher, smtp):
+    dispatcher.submit(_message('first'))
+    dispatcher.queue.join()
+    smtp.drop()
+    dispatcher.submit(_message('second'))
+    dispatcher.queue.join()
+    assert len(smtp.messages) == 2 and _connections(smtp) == 2
+    assert dispatcher.stats['sent'] == 2 and dispatcher.stats['failed'] == 0
+
+
+# 时间窗口内的通知合并成一封，同一篇文章只列一次
+def test_digest_coalesces_notifications(app, dispatcher, smtp):
+    app.config['MYBLOGS_MAIL_DIGEST_WINDOW'] = 60
+    for title in ('first', 'first', 'second'):
+        dispatcher.notify_admin(title, 'http://localhost/post/%s' % title)
+    dispatcher.queue.join()
+    assert smtp.messages == []
+    dispatcher.flush_digest()
+    dispatcher.queue.join()
+    assert len(smtp.messages) == 1
+    body = smtp.messages[0][1]
+    assert body.count('/post/first') == 2 and body.count('/post/second') == 2
+    assert dispatcher.stats['digested'] == 3
+
+
+# 摘要中的文章数达到队列长度时提前发出
+def test_digest_is_bounded(app, smtp):
+    app.config.update(MYBLOGS_MAIL_DIGEST_WINDOW=60, MYBLOGS_MAIL_QUEUE_SIZE=3)
+    dispatcher = MailDispatcher(app)
+    for i in range(7):
+        dispatcher.notify_admin('post %d' % i, 'http://localhost/post/%d' % i)
+    dispatcher.queue.join()
+    assert len(smtp.messages) == 2 and len(dispatcher._digest) == 1
+    dispatcher.shutdown()
+    assert len(smtp.messages) == 3
+
+
+# shutdown 发出未到时间的摘要并等待队列发送完毕
+def test_shutdown_flushes_digest_and_queue(app, dispatcher, smtp):
+    app.config['MYBLOGS_MAIL_DIGEST_WINDOW'] = 60
+    dispatcher.notify_admin('post', 'http://localhost/post/1')
+    for i in range(3):
+        dispatcher.submit(_message('m%d' % i))
+    dispatcher.shutdown()
+    assert len(smtp.messages) == 4
+    assert dispatcher.workers == []
+
+
+class BrokenConnection(object):
+
+    def __init__(self):
+        self.closed = False
+        self.host = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+    def send(self, message):
+        raise OSError('broken pipe')
+
+
+# 新连接上发送失败时关闭连接再抛出异常
+def test_deliver_closes_new_connection_on_failure(app, monkeypatch):
+    connection = BrokenConnection()
+    monkeypatch.setattr(emails.mail, 'connect', lambda: connection)
+    with pytest.raises(OSError):
+        _deliver(None, _message('broken'))
+    assert connection.closed
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    calls = []
+    monkeypatch.setattr(emails.dispatcher, 'submit', lambda message: calls.append(message.subject))
+    monkeypatch.setattr(emails.dispatcher, 'notify_admin', lambda title, url: calls.append(title))
+    return calls
+
+
+# 不使用 Outbox 时，事务提交成功后才交给调度器，回滚的评论不发通知
+def test_dispatcher_mail_waits_for_commit(app, submitted):
+    comment = Comment.query.filter(Comment.email != None).first()
+    with app.test_request_context():
+        emails.send_new_reply_email(comment)
+        emails.send_new_comment_email(comment.post)
+        assert submitted == []
+        db.session.rollback()
+        db.session.commit()
+        assert submitted == []
+
+        emails.send_new_reply_email(comment)
+        db.session.commit()
+    assert submitted == ['新回复']
+
+
+def test_new_comment_notifies_after_commit(app, client, submitted):
+    post = Post.query.first()
+    response = client.post('/post/%d' % post.id, data=dict(author='a', email='a@example.com', body='hi'))
+    assert response.status_code == 302
+    assert submitted == [post.title]
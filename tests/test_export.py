@@ -0,0 +1,108 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+from flask import url_for
+
+from myblogs import export
+from myblogs.export import STATE_FILE, TIME_FORMAT, changed_paths, export_path, export_site, load_state, site_fingerprint
+from myblogs.extensions import db
+from myblogs.models import Admin, Category, Post
+
+
+# 只导出一个主题、评论不分页，减少渲染的页面
+@pytest.fixture
+def output(app, tmp_path):
+    app.config.update(MYBLOGS_THEMES={'perfect_blue': '完美蓝'}, MYBLOGS_COMMENT_PER_PAGE=100)
+    return str(tmp_path / 'export')
+
+
+# 记录 export_site 渲染了哪些路径
+@pytest.fixture
+def rendered(monkeypatch):
+    paths = []
+    render_path = export.render_path
+
+    def record(app, output, theme, path):
+        paths.append(path)
+        return render_path(app, output, theme, path)
+    monkeypatch.setattr(export, 'render_path', record)
+    return paths
+
+
+def _page(output, url):
+    return os.path.join(output, 'perfect_blue', export_path(url))
+
+
+def _urls(app, post):
+    with app.test_request_context():
+        return (url_for('blog.index'), url_for('blog.show_category', category_id=post.category_id),
+                url_for('blog.show_post', post_id=post.id))
+
+
+def test_export_path():
+    assert export_path('/') == 'index.html'
+    assert export_path('/post/3') == os.path.join('post/3', 'index.html')
+    assert export_path('/post/3?after=a/b') == os.path.join('post/3', 'index.after=a%2Fb.html')
+
+
+# 第一次导出渲染全部页面并保存状态，没有修改时再次导出不渲染任何页面
+def test_full_then_unchanged_export(app, output, rendered):
+    written, removed = export_site(output)
+    assert written >= Post.query.count() and removed == 0
+    post = Post.query.first()
+    for url in _urls(app, post):
+        assert os.path.exists(_page(output, url))
+    state = load_state(output)
+    assert state['site'] == site_fingerprint()
+
+    del rendered[:]
+    assert export_site(output) == (0, 0)
+    assert rendered == []
+    assert changed_paths(load_state(output), site_fingerprint()) == ([], False)
+
+
+# 修改一篇文章后只重新渲染这篇文章、它所在的分类和首页
+def test_incremental_export_renders_changed_post(app, output, rendered):
+    export_site(output)
+    post = Post.query.get(5)
+    post.title = 'edited title'
+    db.session.commit()
+    index, category, page = _urls(app, post)
+    mtimes = dict((url, os.path.getmtime(_page(output, url))) for url in ('/about', _urls(app, Post.query.get(6))[2]))
+
+    del rendered[:]
+    written, removed = export_site(output)
+    assert sorted(rendered) == sorted([index, category, page])
+    assert written >= 3 and removed == 0
+    with open(_page(output, page), encoding='utf-8') as f:
+        assert 'edited title' in f.read()
+    for url, mtime in mtimes.items():
+        assert os.path.getmtime(_page(output, url)) == mtime
+
+
+# 站点指纹变化（例如博客标题）时全部重新渲染
+def test_site_change_renders_every_page(app):
+    state = dict(exported_at=datetime.utcnow().strftime(TIME_FORMAT), site=site_fingerprint())
+    assert changed_paths(state, site_fingerprint()) == ([], False)
+    Admin.query.first().blog_title = 'new title'
+    db.session.commit()
+    paths, full = changed_paths(state, site_fingerprint())
+    assert full and len(paths) == Post.query.count() + Category.query.count() + 2
+
+
+# 全量导出删除已经不存在的文章页面
+def test_full_export_removes_stale_pages(app, output):
+    export_site(output)
+    post = Post.query.get(5)
+    page = _page(output, _urls(app, post)[2])
+    assert os.path.exists(page)
+    db.session.delete(post)
+    db.session.commit()
+
+    written, removed = export_site(output, full=True)
+    assert removed >= 1 and not os.path.exists(page)
+    assert not os.path.exists(os.path.dirname(page))
+    with open(os.path.join(output, STATE_FILE)) as f:
+        assert json.load(f)['site'] == site_fingerprint()
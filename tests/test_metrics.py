@@ -0,0 +1,65 @@
+import threading
+
+from flask_sqlalchemy import get_debug_queries
+from sqlalchemy import event
+
+from myblogs.extensions import db
+from myblogs.metrics import Registry
+from myblogs.models import Post
+
+
+def _scrape(app, client, token='secret'):
+    return client.get(app.config['MYBLOGS_METRICS_PATH'], headers={'Authorization': 'Bearer ' + token})
+
+
+def test_slow_queries_by_endpoint(app, client):
+    app.config.update(MYBLOGS_SLOW_QUERY_THRESHOLD=0, MYBLOGS_METRICS_TOKEN='secret')
+    assert client.get('/').status_code == 200
+    body = _scrape(app, client).get_data(as_text=True)
+    assert 'myblogs_sql_slow_queries_total{endpoint="blog.index"}' in body
+    assert 'myblogs_sql_queries_total{endpoint="blog.index"}' in body
+
+
+# 没有配置令牌时不开放，令牌错误时拒绝
+def test_scrape_requires_token(app, client):
+    assert client.get(app.config['MYBLOGS_METRICS_PATH']).status_code == 404
+    app.config['MYBLOGS_METRICS_TOKEN'] = 'secret'
+    assert client.get(app.config['MYBLOGS_METRICS_PATH']).status_code == 403
+    assert _scrape(app, client, 'wrong').status_code == 403
+    assert _scrape(app, client).status_code == 200
+
+
+# 已结束线程的计数表被合并，计数不丢失
+def test_dead_thread_shards_are_retired():
+    registry = Registry()
+    for i in range(20):
+        thread = threading.Thread(target=registry.inc, args=('hits',))
+        thread.start()
+        thread.join()
+    registry.observe('latency', 0.1)
+    counters, histograms = registry.collect()
+    assert counters['hits', ()] == 20
+    assert histograms['latency', ()][-1] == 0.1
+    assert len(registry._shards) == 1
+
+
+# 流式响应的请求耗时和查询数包括正文的渲染
+def test_streamed_request_metrics_include_body(app, client):
+    app.config.update(MYBLOGS_STREAMING=True, MYBLOGS_METRICS_TOKEN='secret')
+    post = Post.query.order_by(Post.reviewed_comment_count.desc()).first()
+    executed = []
+    listener = lambda *args: executed.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    del get_debug_queries()[:]
+    try:
+        response = client.get('/post/%d' % post.id)
+        assert response.is_streamed
+        response.get_data()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    counters, histograms = app.extensions['myblogs_metrics'].collect()
+    endpoint = (('endpoint', 'blog.show_post'),)
+    assert counters['myblogs_sql_queries_total', endpoint] == len(executed)
+    render = histograms['myblogs_template_render_seconds', (('template', 'blog/post.html'),)][-1]
+    assert histograms['myblogs_request_duration_seconds', endpoint][-1] >= render
@@ -0,0 +1,64 @@
+from sqlalchemy.orm import Session
+
+from myblogs.extensions import db
+from myblogs.models import Category, Comment, Post
+
+
+def _counts(post):
+    db.session.refresh(post)
+    return post.comment_count, post.reviewed_comment_count
+
+
+# 计数只累加一次
+def test_comment_counters(app):
+    post = Post.query.first()
+    before = _counts(post)
+    db.session.add(Comment(author='a', email='a@example.com', body='hi', post=post, reviewed=True))
+    db.session.commit()
+    assert _counts(post) == (before[0] + 1, before[1] + 1)
+
+
+def test_moving_post_updates_category_counts(app):
+    post = Post.query.first()
+    old, new = post.category, Category.query.filter(Category.id != post.category_id).first()
+    counts = old.post_count, new.post_count
+    post.category = new
+    db.session.commit()
+    db.session.refresh(old)
+    db.session.refresh(new)
+    assert (old.post_count, new.post_count) == (counts[0] - 1, counts[1] + 1)
+
+
+# 不经过 db.session 的会话也维护计数
+def test_counters_in_other_sessions(app):
+    session = Session(bind=db.engine)
+    post = session.query(Post).first()
+    before = post.comment_count, post.updated
+    session.add(Comment(author='a', email='a@example.com', body='hi', post=post))
+    session.commit()
+    session.refresh(post)
+    assert post.comment_count == before[0] + 1 and post.updated > before[1]
+    session.close()
+
+
+def test_summarize_strips_tags():
+    assert Post.summarize('<p>Hello <b>world</b></p>') == ('Hello world', 11)
+    assert Post.summarize(None) == ('', 0)
+
+
+# 超过 EXCERPT_LENGTH 时截断并加省略号，字数按全文计算
+def test_summarize_truncates_long_text():
+    excerpt, length = Post.summarize('<p>%s</p>' % ('x' * 1000))
+    assert length == 1000
+    assert len(excerpt) == Post.EXCERPT_LENGTH and excerpt.endswith('...')
+    excerpt, length = Post.summarize('y' * Post.EXCERPT_LENGTH)
+    assert excerpt == 'y' * Post.EXCERPT_LENGTH and length == Post.EXCERPT_LENGTH
+
+
+def test_setting_body_updates_excerpt(app):
+    post = Post.query.first()
+    post.body = '<h1>Title</h1><p>%s</p>' % ('z' * 300)
+    db.session.commit()
+    db.session.refresh(post)
+    assert post.excerpt.startswith('Titlezzz') and post.excerpt.endswith('...')
+    assert post.body_length == 305
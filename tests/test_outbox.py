@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+from myblogs.emails import _claim_outbox
+from myblogs.extensions import db
+from myblogs.models import Outbox
+
+
+def _queue(count):
+    for i in range(count):
+        db.session.add(Outbox(subject='s%d' % i, recipient='a@example.com', html='<p>hi</p>'))
+    db.session.commit()
+
+
+# 已领取的邮件在租期内不会被其他进程再次领取
+def test_claimed_rows_are_leased(app):
+    _queue(5)
+    now = datetime.utcnow()
+    first = _claim_outbox(now, 3)
+    second = _claim_outbox(now, 3)
+    assert len(first) == 3 and len(second) == 2
+    assert not set(item.id for item in first) & set(item.id for item in second)
+    assert _claim_outbox(now, 3) == []
+
+
+def test_expired_lease_is_claimed_again(app):
+    _queue(1)
+    now = datetime.utcnow()
+    assert len(_claim_outbox(now, 10)) == 1
+    later = now + timedelta(seconds=app.config['MYBLOGS_OUTBOX_LEASE'] + 1)
+    assert len(_claim_outbox(later, 10)) == 1
@@ -0,0 +1,67 @@
+from datetime import datetime
+
+from flask_sqlalchemy import Pagination
+
+from myblogs.extensions import db
+from myblogs.models import Post
+from myblogs.pagination import KeysetPagination, paginate
+
+
+def _page(app, url, per_page=7):
+    with app.test_request_context(url):
+        return paginate(Post.query, Post.timestamp, Post.id, per_page)
+
+
+def _expected():
+    return [post.id for post in Post.query.order_by(Post.timestamp.desc(), Post.id.desc())]
+
+
+# 时间戳相同的文章按 id 排序，逐页向后翻不重复也不遗漏
+def test_after_cursor_walks_every_post_once(app):
+    Post.query.filter(Post.id <= 10).update({Post.timestamp: datetime(2020, 1, 1)}, synchronize_session=False)
+    db.session.commit()
+    seen, url = [], '/'
+    while True:
+        pagination = _page(app, url)
+        seen.extend(post.id for post in pagination.items)
+        if not pagination.has_next:
+            break
+        url = '/?after=' + pagination.next_cursor
+    assert seen == _expected()
+
+
+def test_before_cursor_returns_previous_page(app):
+    first = _page(app, '/')
+    second = _page(app, '/?after=' + first.next_cursor)
+    assert second.has_prev
+    back = _page(app, '/?before=' + second.prev_cursor)
+    assert [post.id for post in back.items] == [post.id for post in first.items]
+    assert not back.has_prev and back.has_next
+
+
+# before 为空时返回最后一页
+def test_empty_before_returns_last_page(app):
+    last = _page(app, '/?before=')
+    assert [post.id for post in last.items] == _expected()[-7:]
+    assert last.has_prev and not last.has_next
+
+
+# 带 page 参数的旧链接按页码分页
+def test_page_argument_falls_back_to_offset(app):
+    pagination = _page(app, '/?page=2')
+    assert isinstance(pagination, Pagination)
+    assert [post.id for post in pagination.items] == _expected()[7:14]
+    app.config['MYBLOGS_KEYSET_PAGINATION'] = False
+    assert isinstance(_page(app, '/'), Pagination)
+    assert isinstance(_page(app, '/?after=x'), Pagination)
+
+
+def test_ascending_order(app):
+    with app.test_request_context('/'):
+        pagination = KeysetPagination(Post.query, Post.timestamp, Post.id, 5, desc=False)
+    assert [post.id for post in pagination.items] == _expected()[::-1][:5]
+
+
+def test_malformed_cursor_is_bad_request(client):
+    assert client.get('/?after=not-a-cursor').status_code == 400
+    assert client.get('/?before=20200101.x').status_code == 400
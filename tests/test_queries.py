@@ -0,0 +1,90 @@
+import logging
+import re
+
+import pytest
+from flask import g, request
+from flask_sqlalchemy import get_debug_queries
+from sqlalchemy import event
+
+from myblogs.extensions import db
+from myblogs.models import Category, Comment, Post
+
+
+# 记录每个请求执行的查询数。测试中应用上下文一直存在，请求会复用它，所以按请求前后的差值计算
+@pytest.fixture
+def query_counts(app):
+    counts = {}
+
+    @app.before_request
+    def start():
+        g.queries_before = len(get_debug_queries())
+
+    @app.after_request
+    def record(response):
+        counts[request.endpoint] = len(get_debug_queries()) - g.queries_before
+        return response
+    return counts
+
+
+def _busiest_post():
+    return Post.query.order_by(Post.reviewed_comment_count.desc()).first()
+
+
+def _pages():
+    category = Category.query.order_by(Category.post_count.desc()).first()
+    return [
+        ('blog.index', '/'),
+        ('blog.show_category', '/category/%d' % category.id),
+        ('blog.show_post', '/post/%d' % _busiest_post().id),
+    ]
+
+
+# 查询数与每页条数无关：分类、被回复的评论都是批量加载的
+@pytest.mark.parametrize('per_page', [5, 20])
+def test_public_page_query_counts(app, client, query_counts, per_page):
+    app.config.update(MYBLOGS_POST_PER_PAGE=per_page, MYBLOGS_COMMENT_PER_PAGE=per_page)
+    limits = {'blog.index': 4, 'blog.show_category': 3, 'blog.show_post': 4}
+    for endpoint, url in _pages():
+        assert client.get(url).status_code == 200
+        assert query_counts[endpoint] <= limits[endpoint], endpoint
+
+
+@pytest.mark.parametrize('per_page', [5, 20])
+def test_manage_post_query_count(app, admin_client, query_counts, per_page):
+    app.config['MYBLOGS_MANAGE_POST_PER_PAGE'] = per_page
+    assert admin_client.get('/admin/post/manage').status_code == 200
+    assert query_counts['admin.manage_post'] <= 5
+
+
+def test_flat_comments_load_replied_in_one_query(app, client, query_counts):
+    app.config['MYBLOGS_THREADED_COMMENTS'] = False
+    post = Post.query.join(Comment, Comment.post_id == Post.id) \
+        .filter(Comment.replied_id != None, Comment.reviewed == True).first()
+    assert client.get('/post/%d' % post.id).status_code == 200
+    assert query_counts['blog.show_post'] <= 4
+
+
+# 流式响应的正文生成完之后才记录，日志中的查询数包括模板渲染时执行的查询
+def test_streamed_post_logs_all_queries(app, client, caplog):
+    app.config.update(MYBLOGS_STREAMING=True, MYBLOGS_SLOW_QUERY_THRESHOLD=0)
+    post = _busiest_post()
+    executed = []
+    listener = lambda *args: executed.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    caplog.set_level(logging.DEBUG, logger=app.logger.name)
+    # 测试中请求复用 fixture 的应用上下文，先清掉生成数据时记录的查询
+    del get_debug_queries()[:]
+    try:
+        response = client.get('/post/%d' % post.id)
+        assert response.is_streamed
+        response.get_data()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+    summary = [r.getMessage() for r in caplog.records if r.getMessage().startswith('blog.show_post:')]
+    slow = [r for r in caplog.records if r.getMessage().startswith('Slow query')]
+    assert len(summary) == 1 and summary[0].startswith('blog.show_post: %d queries,' % len(executed))
+    assert len(slow) == len(executed)
+    # Server-Timing 在正文之前计算，不包含流式渲染时的查询
+    header_count = int(re.search(r'desc="(\d+) queries"', response.headers['Server-Timing']).group(1))
+    assert header_count < len(executed)
@@ -0,0 +1,16 @@
+from myblogs.extensions import db
+from myblogs.models import Post
+from myblogs.queries import listing_queries, query_plan
+
+
+# 列表页和后台的查询都应当使用索引，不出现全表扫描或临时排序
+def test_listing_queries_use_indexes(app):
+    db.session.execute('ANALYZE')
+    problems = dict((name, query_plan(query)[1]) for name, query in listing_queries())
+    assert problems == dict((name, []) for name in problems)
+
+
+def test_query_plan_reports_table_scan(app):
+    plan, problems = query_plan(Post.query.filter(Post.author == 'x').order_by(Post.title))
+    assert any(detail.startswith('SCAN post') for detail in problems)
+    assert any('TEMP B-TREE' in detail for detail in problems)
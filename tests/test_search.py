@@ -0,0 +1,20 @@
+from myblogs import search
+from myblogs.models import Comment, Post
+
+
+def test_reindex(app):
+    result = app.test_cli_runner().invoke(args=['reindex'])
+    expected = Post.query.count() + Comment.query.filter_by(reviewed=True).count()
+    assert result.exit_code == 0
+    assert '已索引 %d 条记录' % expected in result.output
+
+
+# 非 SQLite 数据库不执行 FTS5 的 DDL，reindex 和 forge 正常结束
+def test_reindex_without_fts(app, monkeypatch):
+    monkeypatch.setattr(search, 'supports_index', lambda connection=None: False)
+    assert search.rebuild_index() is None
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['reindex'])
+    assert result.exit_code == 0 and '不支持全文索引' in result.output
+    result = runner.invoke(args=['forge', '--category', '2', '--post', '5', '--comment', '10'])
+    assert result.exit_code == 0 and '不支持全文索引' in result.output
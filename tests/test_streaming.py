@@ -0,0 +1,87 @@
+import re
+
+import pytest
+from flask import request_finished
+
+from myblogs import emails
+from myblogs.models import Post
+
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+# 开启流式渲染和 CSRF 保护，缓冲区很小，页面分成多段发送
+@pytest.fixture
+def streaming(app, monkeypatch):
+    app.config.update(MYBLOGS_STREAMING=True, MYBLOGS_STREAM_BUFFER=1024)
+    monkeypatch.setattr(emails.dispatcher, 'notify_admin', lambda title, url: None)
+    return app
+
+
+# 测试客户端总是把响应包装成迭代器，从 request_finished 信号取得视图返回的响应
+@pytest.fixture
+def responses(app):
+    result = []
+
+    def record(sender, response):
+        result.append(response)
+    request_finished.connect(record, app)
+    yield result
+    request_finished.disconnect(record, app)
+
+
+def _stream(client, url):
+    response = client.get(url, buffered=False)
+    assert response.status_code == 200
+    chunks = [chunk.decode('utf-8') for chunk in response.response]
+    response.close()
+    return chunks
+
+
+def test_pages_are_streamed(streaming, client, responses):
+    post = Post.query.first()
+    for url in ('/', '/category/%d' % post.category_id, '/post/%d' % post.id):
+        chunks = _stream(client, url)
+        assert responses.pop().is_streamed
+        assert len(chunks) > 1
+        assert ''.join(chunks).rstrip().endswith('</html>')
+
+
+def test_streaming_disabled_renders_whole_page(app, client, responses):
+    assert client.get('/').status_code == 200
+    assert not responses.pop().is_streamed
+
+
+# 闪现消息只显示一次：跳转后的流式页面显示，再次访问时不再显示
+def test_flash_shown_once(streaming, client):
+    post = Post.query.first()
+    message = '谢谢，您的评论将在管理员审查后发布.'
+    response = client.post('/post/%d' % post.id, data=dict(author='a', email='a@example.com', body='hi'))
+    assert response.status_code == 302
+    assert ''.join(_stream(client, '/post/%d' % post.id)).count(message) == 1
+    with client.session_transaction() as session:
+        assert '_flashes' not in session
+    assert message not in ''.join(_stream(client, '/post/%d' % post.id))
+
+
+# 流式页面中的 CSRF 令牌保存在会话里，提交表单时能通过验证
+def test_csrf_token_in_streamed_form(streaming, client):
+    streaming.config['WTF_CSRF_ENABLED'] = True
+    post = Post.query.first()
+    html = ''.join(_stream(client, '/post/%d' % post.id))
+    token = CSRF_RE.search(html).group(1)
+    data = dict(author='a', email='a@example.com', body='hi')
+
+    assert client.post('/post/%d' % post.id, data=data).status_code == 400
+    response = client.post('/post/%d' % post.id, data=dict(data, csrf_token=token))
+    assert response.status_code == 302
+
+
+# 管理员的按钮在模板中调用 csrf_token()，令牌也要在发送响应头之前生成
+def test_admin_csrf_token_in_streamed_page(streaming, admin_client):
+    streaming.config['WTF_CSRF_ENABLED'] = True
+    post = Post.query.first()
+    html = ''.join(_stream(admin_client, '/post/%d' % post.id))
+    tokens = set(CSRF_RE.findall(html))
+    assert len(tokens) == 1
+    data = dict(author='a', email='a@example.com', body='hi', csrf_token=tokens.pop())
+    assert admin_client.post('/post/%d' % post.id, data=data).status_code == 302